@@ -0,0 +1,288 @@
+"""Fleet-wide follower graph and engagement metrics with NumPy.
+
+`export_tables` copies the follows, likes and messages tables into one
+.npy file per column under a directory. The report then opens those
+files memory-mapped, so it works from the page cache rather than the
+database and doesn't need the edges to fit in the Python heap.
+
+All metrics are vectorized over the id columns:
+
+- in/out degree distribution of the follow graph
+- reciprocity: the share of follows that are followed back
+- clustering: global transitivity of the undirected follow graph,
+  estimated from a uniform sample of connected triples
+- engagement: likes per message
+
+NumPy isn't needed by the web app, so it isn't in requirements.txt;
+install it where the report runs.
+"""
+
+import itertools
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+from models import db, Message, Likes, Follows
+
+BATCH_SIZE = 100000
+
+CLUSTERING_SAMPLES = 1000000
+
+# file name -> (columns read from the database, in order)
+TABLES = {
+    'follows': (Follows.user_following_id, Follows.user_being_followed_id),
+    'likes': (Likes.user_id, Likes.message_id),
+    'messages': (Message.id, Message.user_id),
+}
+
+COLUMN_NAMES = {
+    'follows': ('follower', 'followed'),
+    'likes': ('user', 'message'),
+    'messages': ('id', 'user'),
+}
+
+
+def column_path(directory, table, column):
+    return os.path.join(directory, f"{table}.{column}.npy")
+
+
+def export_table(directory, table):
+    """Write each column of `table` to its own .npy file; returns the row count.
+
+    The files are sized from a COUNT(*) taken first; if rows are added
+    while the export runs, the extra rows are left out.
+    """
+
+    columns = TABLES[table]
+    names = COLUMN_NAMES[table]
+    total = db.session.query(*columns).count()
+
+    arrays = [np.lib.format.open_memmap(column_path(directory, table, name), mode='w+',
+                                        dtype=np.int64, shape=(total,))
+              for name in names]
+
+    rows = db.session.query(*columns).yield_per(BATCH_SIZE)
+
+    written = 0
+    while written < total:
+        batch = list(itertools.islice(rows, min(BATCH_SIZE, total - written)))
+        if not batch:
+            break
+        block = np.array(batch, dtype=np.int64)
+        for i, array in enumerate(arrays):
+            array[written:written + len(batch)] = block[:, i]
+        written += len(batch)
+
+    for array in arrays:
+        array.flush()
+
+    return written
+
+
+def export_tables(directory):
+    """Export every table in TABLES to `directory`; returns the row counts."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    counts = {table: export_table(directory, table) for table in TABLES}
+    meta = {'exported_at': datetime.utcnow().isoformat(), 'rows': counts}
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    return counts
+
+
+class GraphData:
+    """The exported columns of one directory, memory-mapped read-only."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as file:
+            self.meta = json.load(file)
+
+        for table, names in COLUMN_NAMES.items():
+            rows = self.meta['rows'][table]
+            for name in names:
+                array = np.load(column_path(directory, table, name), mmap_mode='r')
+                setattr(self, f"{table}_{name}", array[:rows])
+
+    @property
+    def user_count(self):
+        """One more than the highest user id seen, for bincount sizing."""
+
+        highest = [column.max() for column in (self.follows_follower, self.follows_followed,
+                                               self.likes_user, self.messages_user)
+                   if len(column)]
+        return int(max(highest)) + 1 if highest else 0
+
+
+def summarize(values):
+    """Count, mean, percentiles and max of an integer array."""
+
+    if not len(values):
+        return {'count': 0, 'mean': 0.0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        'count': int(len(values)),
+        'mean': float(values.mean()),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': int(values.max()),
+    }
+
+
+def log2_histogram(values):
+    """{'0': n, '1': n, '2-3': n, '4-7': n, ...} for non-negative integers."""
+
+    buckets = np.zeros(len(values), dtype=np.int64)
+    positive = values > 0
+    buckets[positive] = np.floor(np.log2(values[positive])).astype(np.int64) + 1
+    counts = np.bincount(buckets)
+
+    histogram = {}
+    for bucket, count in enumerate(counts):
+        if not count:
+            continue
+        low, high = (0, 0) if bucket == 0 else (2 ** (bucket - 1), 2 ** bucket - 1)
+        histogram[str(low) if low == high else f"{low}-{high}"] = int(count)
+    return histogram
+
+
+def degrees(data):
+    """In and out degree per user id (ids with no account count as 0)."""
+
+    n = data.user_count
+    out_degree = np.bincount(data.follows_follower, minlength=n)
+    in_degree = np.bincount(data.follows_followed, minlength=n)
+    return out_degree, in_degree
+
+
+def sorted_unique(values):
+    """Sorted distinct values and how often each occurs.
+
+    Same as np.unique(values, return_counts=True), spelled out because
+    newer NumPy releases may pick a much slower hash-based path for it.
+    """
+
+    values = np.sort(values)
+    if not len(values):
+        return values, np.zeros(0, dtype=np.int64)
+
+    starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+    return values[starts], np.diff(np.append(starts, len(values)))
+
+
+def reciprocity(follower, followed, n):
+    """Share of edges u->v for which v->u also exists.
+
+    Both directions of a mutual follow map to the same unordered pair, so
+    they show up as a pair counted twice.
+    """
+
+    if not len(follower):
+        return 0.0
+
+    pairs = np.minimum(follower, followed) * n + np.maximum(follower, followed)
+    counts = sorted_unique(pairs)[1]
+    return float(counts[counts == 2].sum() / len(follower))
+
+
+def clustering(follower, followed, n, samples=CLUSTERING_SAMPLES, seed=0):
+    """Estimated global clustering coefficient (transitivity).
+
+    Picks `samples` connected triples (v - u - w) uniformly at random and
+    returns the share that are closed by a v - w edge. The standard error
+    is at most 0.5 / sqrt(samples).
+    """
+
+    keep = follower != followed
+    low = np.minimum(follower[keep], followed[keep])
+    high = np.maximum(follower[keep], followed[keep])
+    keys = sorted_unique(low * n + high)[0]
+    if not len(keys):
+        return 0.0
+
+    # adjacency lists in CSR form, from the edges in both directions sorted
+    # by their first end: neighbours of u are neighbours[offsets[u]:offsets[u + 1]]
+    low, high = np.divmod(keys, n)
+    ends, neighbours = np.divmod(np.sort(np.concatenate([keys, high * n + low])), n)
+    degree = np.bincount(ends, minlength=n)
+    offsets = np.concatenate([[0], np.cumsum(degree)])
+
+    triples = degree * (degree - 1) // 2
+    total = triples.sum()
+    if not total:
+        return 0.0
+
+    rng = np.random.default_rng(seed)
+    centres = np.searchsorted(np.cumsum(triples), rng.integers(0, total, samples), side='right')
+
+    centre_degree = degree[centres]
+    first = rng.integers(0, centre_degree)
+    second = rng.integers(0, centre_degree - 1)
+    second += second >= first
+
+    v = neighbours[offsets[centres] + first]
+    w = neighbours[offsets[centres] + second]
+
+    # sorted lookups are far more cache-friendly than random ones
+    closing = np.sort(np.minimum(v, w) * n + np.maximum(v, w))
+    found = np.searchsorted(keys, closing)
+    found[found == len(keys)] = 0
+    return float((keys[found] == closing).mean())
+
+
+def engagement(data, top=10):
+    """Likes per message, and the most-liked messages."""
+
+    if not len(data.messages_id):
+        return {'likes_per_message': summarize(np.zeros(0, dtype=np.int64)),
+                'liked_share': 0.0, 'top': []}
+
+    # message ids are sparse 64-bit values, so count likes by each
+    # message's position in sorted id order rather than by id
+    order = np.argsort(data.messages_id, kind='stable')
+    ids = data.messages_id[order]
+    found = np.minimum(np.searchsorted(ids, data.likes_message), len(ids) - 1)
+    found = found[ids[found] == data.likes_message]
+    likes = np.empty(len(ids), dtype=np.int64)
+    likes[order] = np.bincount(found, minlength=len(ids))
+
+    top = min(top, len(likes))
+    best = np.argpartition(-likes, top - 1)[:top]
+    best = best[np.argsort(-likes[best], kind='stable')]
+
+    return {
+        'likes_per_message': summarize(likes),
+        'liked_share': float((likes > 0).mean()),
+        'top': [{'message_id': int(data.messages_id[i]), 'likes': int(likes[i])}
+                for i in best if likes[i]],
+    }
+
+
+def report(directory, samples=CLUSTERING_SAMPLES, seed=0):
+    """Every metric for the export in `directory`, as a JSON-able dict."""
+
+    data = GraphData(directory)
+    n = data.user_count
+    out_degree, in_degree = degrees(data)
+
+    # only users that appear somewhere count towards the distribution
+    active = np.zeros(n, dtype=bool)
+    for column in (data.follows_follower, data.follows_followed, data.likes_user, data.messages_user):
+        active[column] = True
+
+    return {
+        'exported_at': data.meta['exported_at'],
+        'rows': data.meta['rows'],
+        'users': int(active.sum()),
+        'out_degree': dict(summarize(out_degree[active]), histogram=log2_histogram(out_degree[active])),
+        'in_degree': dict(summarize(in_degree[active]), histogram=log2_histogram(in_degree[active])),
+        'reciprocity': reciprocity(data.follows_follower, data.follows_followed, n),
+        'clustering': clustering(data.follows_follower, data.follows_followed, n, samples, seed),
+        'engagement': engagement(data),
+    }
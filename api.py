@@ -0,0 +1,311 @@
+"""Versioned JSON API, mounted at /api/v1.
+
+Read-only JSON views of users, timelines, messages, likes and follows for
+the mobile clients, which otherwise scrape the HTML pages. Rows are
+serialized straight from column queries rather than hydrating ORM
+objects and their relationships.
+
+Lists are paginated with an opaque cursor: each page is
+{"items": [...], "next_cursor": "..."}, and passing `cursor` back gets
+the page after it. Every response has a weak ETag, so clients can
+revalidate with If-None-Match and get a 304.
+
+POST /api/v1/batch runs several GETs in one round trip:
+
+    {"requests": [{"path": "/api/v1/timeline"},
+                  {"path": "/api/v1/users/1", "etag": "W/\"...\""}]}
+
+and responds with {"responses": [{"status", "etag", "body"}, ...]} in
+the same order.
+"""
+
+import base64
+import hashlib
+import json
+
+from flask import Blueprint, current_app, g, jsonify, request, abort
+from sqlalchemy import func
+from werkzeug.exceptions import HTTPException
+
+from models import db, User, Message, ArchivedMessage, Likes, Follows
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# most sub-requests a batch may hold
+BATCH_LIMIT = 20
+
+
+@api.before_request
+def require_user():
+    if not g.user:
+        return jsonify({'error': "Access unauthorized."}), 401
+
+
+@api.errorhandler(HTTPException)
+def error_response(exc):
+    return jsonify({'error': exc.description}), exc.code
+
+
+def json_response(data):
+    """`data` as JSON with a weak ETag, or 304 if the client's matches."""
+
+    resp = jsonify(data)
+    resp.set_etag(hashlib.sha1(resp.get_data()).hexdigest(), weak=True)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
+
+
+##############################################################################
+# Pagination
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor():
+    """The values in the request's `cursor`, or None if there isn't one."""
+
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400, "Invalid cursor.")
+
+
+def decode_id_cursor():
+    """The id in a cursor from `encode_cursor(id)`, or None."""
+
+    cursor = decode_cursor()
+    if cursor is None:
+        return None
+    if not (isinstance(cursor, list) and len(cursor) == 1 and isinstance(cursor[0], int)):
+        abort(400, "Invalid cursor.")
+    return cursor[0]
+
+
+def page_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if not limit or limit < 1:
+        abort(400, "limit must be a positive integer.")
+    return min(limit, MAX_LIMIT)
+
+
+def page(items, limit, cursor_of):
+    """A page of the first `limit` of `items`, which should hold one more
+    than that if there's a next page."""
+
+    next_cursor = cursor_of(items[limit - 1]) if len(items) > limit else None
+    return {'items': items[:limit], 'next_cursor': next_cursor}
+
+
+##############################################################################
+# Serialization
+
+
+def iso(when):
+    return when.isoformat() + 'Z'
+
+
+def user_summary(user_id, username, image_url):
+    return {'id': user_id, 'username': username, 'image_url': image_url}
+
+
+def message_query(model):
+    """Column query for messages of `model` (live or archived) with their
+    authors, newest first."""
+
+    return (db.session.query(model.id, model.text, model.timestamp,
+                             User.id, User.username, User.image_url)
+            .join(User, User.id == model.user_id)
+            .order_by(model.id.desc()))
+
+
+def serialize_messages(rows):
+    """Message rows from `message_query` as dicts, flagged with whether the
+    current user likes each one."""
+
+    ids = [row[0] for row in rows]
+    liked = set()
+    if ids:
+        liked = {message_id for message_id, in (db.session.query(Likes.message_id)
+                                                .filter(Likes.user_id == g.user.id, Likes.message_id.in_(ids)))}
+
+    return [{'id': message_id, 'text': text, 'timestamp': iso(timestamp),
+             'user': user_summary(user_id, username, image_url), 'liked': message_id in liked}
+            for message_id, text, timestamp, user_id, username, image_url, *_ in rows]
+
+
+def message_page(queries):
+    """A page of messages from `queries` (per tier), merged newest first.
+    Message ids are time-sortable, so the cursor is the last id."""
+
+    limit = page_limit()
+    before = decode_id_cursor()
+
+    rows = []
+    for model, query in queries:
+        if before is not None:
+            query = query.filter(model.id < before)
+        rows += query.limit(limit + 1).all()
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    return page(serialize_messages(rows[:limit + 1]), limit, lambda message: encode_cursor(message['id']))
+
+
+def user_page(query):
+    """A page of users from `query`, in id order."""
+
+    limit = page_limit()
+    after = decode_id_cursor()
+    if after is not None:
+        query = query.filter(User.id > after)
+
+    rows = query.order_by(User.id).limit(limit + 1).all()
+    return page([user_summary(*row) for row in rows], limit, lambda user: encode_cursor(user['id']))
+
+
+def count(query, name):
+    return query.with_entities(func.count()).label(name)
+
+
+##############################################################################
+# Views
+
+
+@api.route('/users/<int:user_id>')
+def user(user_id):
+    """A user's profile, with counts of messages, follows and likes."""
+
+    row = (db.session.query(User.id, User.username, User.image_url, User.header_image_url, User.bio,
+                            User.location,
+                            count(Message.query.filter(Message.user_id == user_id), 'messages'),
+                            count(ArchivedMessage.query.filter(ArchivedMessage.user_id == user_id), 'archived'),
+                            count(Follows.query.filter(Follows.user_being_followed_id == user_id), 'followers'),
+                            count(Follows.query.filter(Follows.user_following_id == user_id), 'following'),
+                            count(Likes.query.filter(Likes.user_id == user_id), 'likes'),
+                            count(Follows.query.filter(Follows.user_being_followed_id == user_id,
+                                                       Follows.user_following_id == g.user.id), 'followed'))
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        abort(404, "No such user.")
+
+    (user_id, username, image_url, header_image_url, bio, location,
+     messages, archived, followers, following, likes, followed) = row
+
+    return json_response({
+        **user_summary(user_id, username, image_url),
+        'header_image_url': header_image_url,
+        'bio': bio,
+        'location': location,
+        'messages_count': messages + archived,
+        'followers_count': followers,
+        'following_count': following,
+        'likes_count': likes,
+        'followed_by_you': bool(followed),
+    })
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first, archived ones included."""
+
+    return json_response(message_page([
+        (Message, message_query(Message).filter(Message.user_id == user_id)),
+        (ArchivedMessage, message_query(ArchivedMessage).filter(ArchivedMessage.user_id == user_id)),
+    ]))
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages a user has liked, most recently liked first."""
+
+    limit = page_limit()
+    before = decode_id_cursor()
+
+    query = (db.session.query(Message.id, Message.text, Message.timestamp,
+                              User.id, User.username, User.image_url, Likes.id)
+             .join(Likes, Likes.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id))
+    if before is not None:
+        query = query.filter(Likes.id < before)
+
+    rows = query.order_by(Likes.id.desc()).limit(limit + 1).all()
+    like_ids = {row[0]: row[-1] for row in rows}
+
+    return json_response(page(serialize_messages(rows), limit,
+                              lambda message: encode_cursor(like_ids[message['id']])))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    return json_response(user_page(db.session.query(User.id, User.username, User.image_url)
+                                   .join(Follows, Follows.user_following_id == User.id)
+                                   .filter(Follows.user_being_followed_id == user_id)))
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    return json_response(user_page(db.session.query(User.id, User.username, User.image_url)
+                                   .join(Follows, Follows.user_being_followed_id == User.id)
+                                   .filter(Follows.user_following_id == user_id)))
+
+
+@api.route('/timeline')
+def timeline():
+    """Messages from the users the current user follows, newest first."""
+
+    return json_response(message_page([
+        (Message, message_query(Message)
+                  .join(Follows, Follows.user_being_followed_id == Message.user_id)
+                  .filter(Follows.user_following_id == g.user.id)),
+    ]))
+
+
+@api.route('/messages/<int:message_id>')
+def message(message_id):
+    for model in (Message, ArchivedMessage):
+        row = message_query(model).filter(model.id == message_id).first()
+        if row:
+            return json_response(serialize_messages([row])[0])
+    abort(404, "No such message.")
+
+
+@api.route('/batch', methods=['POST'])
+def batch():
+    """Run several GETs against this API in one request."""
+
+    data = request.get_json(silent=True) or {}
+    subrequests = data.get('requests')
+    if (not isinstance(subrequests, list)
+            or not all(isinstance(sub, dict) and isinstance(sub.get('path'), str) for sub in subrequests)):
+        abort(400, "requests must be a list of {\"path\": ...} objects.")
+    if len(subrequests) > BATCH_LIMIT:
+        abort(400, f"At most {BATCH_LIMIT} requests per batch.")
+
+    return jsonify({'responses': [dispatch(sub['path'], sub.get('etag')) for sub in subrequests]})
+
+
+def dispatch(path, etag=None):
+    """Run the API view for GET `path` within this request, as the same
+    user; {'status', 'etag', 'body'}."""
+
+    headers = {'If-None-Match': etag} if etag else {}
+    with current_app.test_request_context(path, method='GET', headers=headers):
+        try:
+            if request.routing_exception:
+                raise request.routing_exception
+            if request.blueprint != api.name or request.endpoint == f"{api.name}.batch":
+                abort(404, "Only GET requests to this API can be batched.")
+            resp = current_app.make_response(current_app.view_functions[request.endpoint](**request.view_args))
+        except HTTPException as exc:
+            resp = current_app.make_response(error_response(exc))
+
+        body = resp.get_json() if resp.status_code != 304 else None
+        return {'status': resp.status_code, 'etag': resp.headers.get('ETag'), 'body': body}
@@ -1,11 +1,48 @@
+import json
+import mimetypes
 import os
+import time
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, Response, render_template, request, flash, redirect, session, g, jsonify,
+                   stream_with_context, send_file, send_from_directory, get_flashed_messages, abort,
+                   make_response)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeoutError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, ArchivedMessage, Likes, Follows
+from trending import tracker as trending
+from group_commit import GroupCommitter
+from cache import LocalCache, ModelCache, make_backend
+from pubsub import make_broker
+from ratelimit import RateLimiter, LoadShedder, make_bucket_store, retry_after_header
+from breaker import CircuitBreaker
+import export
+import importer
+import follows
+import archive
+import hashtags
+from prepared import hot_queries
+from loader import batch_loader
+from availability import index as availability
+from assets import manifest as assets, build as build_assets
+import streaming
+from streaming import LazyList, stream_template, compress_response
+import imageproxy
+from imageproxy import ImageCache, ImageFetchError
+import slowlog
+from slowlog import SlowQueryLog
+from public_timeline import PublicTimeline, make_store
+import notifications
+from api import api
+from snowflake import message_ids, check_worker_id
+import id_migration
+import likes_migration
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,26 +57,339 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Opt-in group commit: coalesce message inserts arriving within a few
+# milliseconds of each other into a single transaction.
+app.config['GROUP_COMMIT'] = os.environ.get('GROUP_COMMIT') == '1'
+app.config['GROUP_COMMIT_WINDOW'] = float(os.environ.get('GROUP_COMMIT_WINDOW', 0.005))
+
+# Primary-key cache for users and messages: 'local' (per process) or
+# 'shared' (Redis at CACHE_REDIS_URL, or an in-process stand-in without it)
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+app.config['CACHE_MAXSIZE'] = int(os.environ.get('CACHE_MAXSIZE', 10000))
+
+# Live timeline updates go through Redis pub/sub when PUBSUB_REDIS_URL is
+# set, so followers connected to other worker processes hear about them.
+app.config['PUBSUB_REDIS_URL'] = os.environ.get('PUBSUB_REDIS_URL')
+app.config['STREAM_KEEPALIVE'] = 15
+
+# Token buckets for write routes, as (tokens per second, burst size) per
+# user and per IP address. Buckets are shared through Redis when
+# RATELIMIT_REDIS_URL is set.
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+app.config['RATELIMIT_REDIS_URL'] = os.environ.get('RATELIMIT_REDIS_URL')
+app.config['RATE_LIMITS'] = {
+    'signup': {'ip': (5 / 3600, 5)},
+    'login': {'ip': (10 / 60, 10)},
+    'messages_add': {'user': (1 / 6, 10), 'ip': (1, 30)},
+    'add_like': {'user': (1, 30), 'ip': (5, 100)},
+    'add_follow': {'user': (1 / 2, 20), 'ip': (5, 100)},
+    'follow_many': {'user': (1 / 60, 5)},
+    'messages_import': {'user': (1 / 60, 5)},
+    'check_available': {'ip': (1, 30)},
+    # checked inside check_available, so an account can't enumerate e-mails
+    'check_available_email': {'user': (1 / 10, 10)},
+}
+# Behind a load balancer or reverse proxy, set PROXY_FIX_X_FOR to the
+# number of proxies in front of the app so that per-IP limits apply to the
+# client address from X-Forwarded-For rather than to the proxy. Leave it
+# at 0 otherwise: the header is trivially spoofed by clients.
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+# Shed write requests beyond this many in flight, or while checking out a
+# database connection takes longer than this many seconds on average.
+app.config['SHED_MAX_CONCURRENT'] = int(os.environ.get('SHED_MAX_CONCURRENT', 20))
+app.config['SHED_POOL_WAIT'] = float(os.environ.get('SHED_POOL_WAIT', 0.5))
+
+# Circuit breaker: stop querying the database when statements average over
+# BREAKER_LATENCY seconds or BREAKER_ERRORS errors happen in a row, and
+# serve the last rendered timelines and profiles until a probe succeeds.
+app.config['BREAKER_LATENCY'] = float(os.environ.get('BREAKER_LATENCY', 1.0))
+app.config['BREAKER_ERRORS'] = int(os.environ.get('BREAKER_ERRORS', 5))
+app.config['BREAKER_COOLDOWN'] = float(os.environ.get('BREAKER_COOLDOWN', 5))
+# the latency average must cover this many statements before it can trip
+app.config['BREAKER_MIN_SAMPLES'] = int(os.environ.get('BREAKER_MIN_SAMPLES', 20))
+# bytes of rendered pages each worker keeps to serve while the breaker is open
+app.config['SNAPSHOT_MAX_BYTES'] = int(os.environ.get('SNAPSHOT_MAX_BYTES', 64 * 1024 * 1024))
+
+# Run the hottest queries as server-side prepared statements on Postgres
+# (set PREPARED_STATEMENTS=0 to compare against unprepared queries)
+app.config['PREPARED_STATEMENTS'] = os.environ.get('PREPARED_STATEMENTS', '1') == '1'
+
+# Send the heaviest pages progressively as they render (STREAM_TEMPLATES=1),
+# and gzip/brotli responses for clients that accept it. Streaming is opt-in:
+# once a page has started going out, a database error partway through can
+# only cut it short rather than show an error page.
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES') == '1'
+app.config['COMPRESS_RESPONSES'] = os.environ.get('COMPRESS_RESPONSES', '1') == '1'
+
+# Avatars and header images are fetched once and served resized from this
+# directory, which is kept under IMAGE_CACHE_MAX_BYTES. Sources on private
+# addresses are refused unless IMAGE_PROXY_ALLOW_PRIVATE=1.
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image-cache'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = os.environ.get('IMAGE_PROXY_ALLOW_PRIVATE') == '1'
+
+# Opt-in slow-query log: statements over SLOW_QUERY_THRESHOLD seconds are
+# written to SLOW_QUERY_LOG_PATH (rotated), with an EXPLAIN ANALYZE plan on
+# Postgres unless SLOW_QUERY_EXPLAIN=0. Summarize with `flask slow-queries`.
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG') == '1'
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.2))
+app.config['SLOW_QUERY_LOG_PATH'] = os.environ.get(
+    'SLOW_QUERY_LOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log', 'slow-queries.log'))
+app.config['SLOW_QUERY_EXPLAIN'] = os.environ.get('SLOW_QUERY_EXPLAIN', '1') == '1'
+
+# Logged-out visitors share one snapshot of the latest messages, rebuilt
+# at most every PUBLIC_TIMELINE_TTL seconds and kept in Redis at
+# PUBLIC_TIMELINE_REDIS_URL when set (per process otherwise).
+app.config['PUBLIC_TIMELINE_TTL'] = int(os.environ.get('PUBLIC_TIMELINE_TTL', 30))
+app.config['PUBLIC_TIMELINE_REDIS_URL'] = os.environ.get('PUBLIC_TIMELINE_REDIS_URL')
+
+# `flask compact-notifications` collapses notifications older than this
+# many days into per-message and per-user aggregates.
+app.config['NOTIFICATIONS_COMPACT_DAYS'] = int(os.environ.get('NOTIFICATIONS_COMPACT_DAYS',
+                                                              notifications.COMPACT_AFTER_DAYS))
+
+# Worker id for this process's message ids, from 0 to 1021 (the rest are
+# reserved). Left unset, each process claims a free one from Postgres
+# (see snowflake.py).
+app.config['SNOWFLAKE_WORKER_ID'] = (int(os.environ['SNOWFLAKE_WORKER_ID'])
+                                     if os.environ.get('SNOWFLAKE_WORKER_ID') else None)
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+app.register_blueprint(api)
+
+message_committer = GroupCommitter(Message.__table__, window=app.config['GROUP_COMMIT_WINDOW'],
+                                   on_insert=hashtags.index_inserted)
+
+cache = ModelCache(make_backend(app.config))
+cache.watch(User, Message)
+
+broker = make_broker(app.config)
+
+trending.init_app(app)
+
+hot_queries.enabled = app.config['PREPARED_STATEMENTS']
+
+message_ids.worker_id = check_worker_id(app.config['SNOWFLAKE_WORKER_ID'])
+
+images = ImageCache(app.config['IMAGE_CACHE_DIR'], max_bytes=app.config['IMAGE_CACHE_MAX_BYTES'],
+                    allow_private=app.config['IMAGE_PROXY_ALLOW_PRIVATE'])
+
+slow_queries = SlowQueryLog(app.config['SLOW_QUERY_LOG_PATH'], threshold=app.config['SLOW_QUERY_THRESHOLD'],
+                            explain=app.config['SLOW_QUERY_EXPLAIN'], prepared=hot_queries.statement)
+if app.config['SLOW_QUERY_LOG']:
+    with app.app_context():
+        slow_queries.watch(db.engine)
+
+public_timeline = PublicTimeline(make_store(app.config['PUBLIC_TIMELINE_REDIS_URL']),
+                                 ttl=app.config['PUBLIC_TIMELINE_TTL'])
+
+limiter = RateLimiter(make_bucket_store(app.config), app.config['RATE_LIMITS'])
+shedder = LoadShedder(max_concurrent=app.config['SHED_MAX_CONCURRENT'],
+                      wait_threshold=app.config['SHED_POOL_WAIT'])
+
+breaker = CircuitBreaker(latency_threshold=app.config['BREAKER_LATENCY'],
+                         error_threshold=app.config['BREAKER_ERRORS'],
+                         cooldown=app.config['BREAKER_COOLDOWN'],
+                         min_samples=app.config['BREAKER_MIN_SAMPLES'])
+with app.app_context():
+    breaker.watch(db.engine)
+
+# last rendered HTML of each (path, viewer), served while the breaker is open
+snapshots = LocalCache(maxsize=10000, ttl=24 * 60 * 60, maxbytes=app.config['SNAPSHOT_MAX_BYTES'],
+                       sizeof=lambda snapshot: len(snapshot[0]))
+SNAPSHOT_ENDPOINTS = ('homepage', 'users_show')
+
+# endpoints serving files, which need no user or database
+STATIC_ENDPOINTS = ('static', 'asset', 'image')
+# GET endpoints in RATE_LIMITS; other endpoints are only limited on POST
+RATE_LIMITED_READS = ('check_available',)
+# fingerprinted assets never change under the same URL
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+# proxied images can change at their source, so they're cached for a while
+IMAGE_MAX_AGE = 7 * 24 * 60 * 60
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+@app.before_request
+def check_breaker():
+    """Keep requests off the database while the circuit breaker is open.
+
+    Registered first, so nothing touches the database before this runs.
+    """
+
+    if request.endpoint is None or request.endpoint in STATIC_ENDPOINTS or not breaker.is_open:
+        return
+
+    if breaker.claim_probe() and breaker.probe(probe_db):
+        return
+
+    return degraded_response()
+
+
+def probe_db():
+    try:
+        db.session.execute(text('SELECT 1'))
+    finally:
+        db.session.rollback()
+
+
+def snapshot_key():
+    return (request.path, session.get(CURR_USER_KEY))
+
+
+def render_page(template_name, snapshot=False, **context):
+    """Render a template, streaming it out as it renders if STREAM_TEMPLATES
+    is on. With snapshot=True, keep a copy of the HTML to serve if the
+    database fails later, unless the page shows flashed messages, which
+    were only meant to be shown once.
+    """
+
+    snapshot = snapshot and '_flashes' not in session
+
+    if not app.config['STREAM_TEMPLATES']:
+        html = render_template(template_name, **context)
+        if snapshot:
+            snapshots.set(snapshot_key(), (html, datetime.utcnow()))
+        return html
+
+    key = snapshot_key()
+
+    # take flashed messages out of the session now; it's saved before the
+    # body is streamed
+    get_flashed_messages()
+
+    def generate():
+        chunks = []
+        try:
+            for chunk in stream_template(template_name, **context):
+                if snapshot:
+                    chunks.append(chunk)
+                yield chunk
+        except (OperationalError, PoolTimeoutError):
+            # the headers have gone out, so there's no error page to switch
+            # to; end the page here and count the failure
+            db.session.rollback()
+            breaker.record_error()
+            return
+
+        if snapshot:
+            snapshots.set(key, (''.join(chunks), datetime.utcnow()))
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+def degraded_response():
+    """Stale page with a banner for snapshotted pages, else "try again"."""
+
+    g.user = None
+
+    snapshot = snapshots.get(snapshot_key())
+    if request.method == 'GET' and request.endpoint in SNAPSHOT_ENDPOINTS and snapshot:
+        return with_stale_banner(*snapshot)
+
+    # logged-out visitors get the last shared public timeline
+    if request.method == 'GET' and request.endpoint == 'homepage' and session.get(CURR_USER_KEY) is None:
+        timeline = public_timeline.load()
+        if timeline:
+            html = render_template('home-anon.html', timeline=Markup(timeline['html']))
+            return with_stale_banner(html, datetime.utcfromtimestamp(timeline['built_at']))
+
+    return (render_template('degraded.html'), 503,
+            {'Retry-After': retry_after_header(app.config['BREAKER_COOLDOWN'])})
+
+
+def with_stale_banner(html, rendered_at):
+    banner = render_template('stale-banner.html', rendered_at=rendered_at)
+    return html.replace('<div class="container">', '<div class="container">' + banner, 1)
+
+
+@app.errorhandler(OperationalError)
+@app.errorhandler(PoolTimeoutError)
+def database_unavailable(exc):
+    """Count the failure against the breaker and answer from snapshots."""
+
+    db.session.rollback()
+    breaker.record_error()
+    return degraded_response()
+
+
+@app.before_request
+def time_db_checkout():
+    """Check out this request's DB connection up front, timing the pool wait.
+
+    Registered before add_user_to_g so it sees the request's first checkout.
+    """
+
+    if request.endpoint is None or request.endpoint in STATIC_ENDPOINTS:
+        return
+
+    start = time.monotonic()
+    db.session.connection()
+    shedder.record_wait(time.monotonic() - start)
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if request.endpoint not in STATIC_ENDPOINTS and CURR_USER_KEY in session:
+        g.user = hot_queries.run('user_by_id', session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.before_request
+def limit_writes():
+    """Apply rate limits and load shedding to POSTs on write routes, and
+    rate limits to the few reads in RATE_LIMITED_READS."""
+
+    write = request.method == 'POST'
+    if (not app.config['RATELIMIT_ENABLED'] or request.endpoint not in app.config['RATE_LIMITS']
+            or not (write or request.endpoint in RATE_LIMITED_READS)):
+        return
+
+    wait = limiter.check(request.endpoint, g.user.id if g.user else None, request.remote_addr)
+    if wait:
+        return too_busy("Too many requests. Please slow down and try again.", 429, wait)
+
+    if not write:
+        return
+
+    if not shedder.acquire():
+        return too_busy("Warbler is very busy right now. Please try again in a moment.", 503, 1)
+    g.write_slot = True
+
+
+@app.teardown_request
+def release_write_slot(exc):
+    if g.pop('write_slot', False):
+        shedder.release()
+
+
+@app.teardown_request
+def drop_batch_loader(exc):
+    g.pop('batch_loader', None)
+
+
+def too_busy(message, status, retry_after):
+    """Plain-text refusal telling the client when to come back."""
+
+    return Response(message, status=status, mimetype='text/plain',
+                    headers={'Retry-After': retry_after_header(retry_after)})
+
+
 def do_login(user):
     """Log in user."""
 
@@ -68,6 +418,13 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # rule out taken names before spending a bcrypt hash on the password
+        taken = availability.taken(username=form.username.data, email=form.email.data)
+        if taken:
+            for field in taken:
+                flash(f"{form[field].label.text} already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -81,6 +438,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(user.id, username=user.username, email=user.email)
         do_login(user)
 
         return redirect("/")
@@ -131,28 +489,24 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = LazyList(User.query.all)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = LazyList(User.query.filter(User.username.like(f"%{search}%")).all)
 
-    return render_template('users/index.html', users=users)
+    return render_page('users/index.html', users=users)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = cache.get_or_404(User, user_id)
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, likes=[m.id for m in g.user.likes])
+    messages = LazyList(lambda: batch_loader().prime(archive.user_messages(user_id, limit=100), 'user'))
+    return render_page('users/show.html', snapshot=True, user=user, messages=messages,
+                       likes=[m.id for m in g.user.likes])
 
 
 @app.route('/users/<int:user_id>/following')
@@ -163,7 +517,7 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = cache.get_or_404(User, user_id)
     return render_template('users/following.html', user=user)
 
 
@@ -175,10 +529,25 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = cache.get_or_404(User, user_id)
     return render_template('users/followers.html', user=user)
 
 
+@app.template_global()
+def following_ids():
+    """Ids of the users the logged-in user follows, loaded once per request
+    for the follow buttons on user lists."""
+
+    if not g.user:
+        return set()
+
+    if 'following_ids' not in g:
+        g.following_ids = {id for (id,) in (db.session
+                                            .query(Follows.user_being_followed_id)
+                                            .filter(Follows.user_following_id == g.user.id))}
+    return g.following_ids
+
+
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
@@ -188,7 +557,8 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if follows.add_follows(g.user.id, [followed_user.id]):
+        notifications.notify(followed_user.id, notifications.FOLLOW, g.user.id)
     db.session.commit()
 
     return redirect(request.referrer)
@@ -202,12 +572,37 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    follows.remove_follows(g.user.id, [follow_id])
     db.session.commit()
 
     return redirect(request.referrer)
 
+
+@app.route('/users/follow', methods=['POST'])
+def follow_many():
+    """Follow many users at once for the currently-logged-in user.
+
+    Request body is JSON: {"user_ids": [...]} and/or {"usernames": [...]}.
+    Responds with JSON counts of users followed, already followed and not
+    found.
+    """
+
+    if not g.user:
+        return jsonify({'error': "Access unauthorized."}), 401
+
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids', [])
+    usernames = data.get('usernames', [])
+    if (not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids)
+            or not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames)):
+        return jsonify({'error': "user_ids must be a list of ids and usernames a list of strings."}), 400
+
+    result = follows.import_follows(g.user.id, usernames)
+    for key, count in follows.follow_users(g.user.id, user_ids).items():
+        result[key] += count
+
+    return jsonify(result)
+
 @app.route('/user/<int:user_id>/liked')
 def show_likes(user_id):
     """Show list of messages this user has liked"""
@@ -216,7 +611,8 @@ def show_likes(user_id):
         return redirect('/')
 
     user = User.query.get_or_404(user_id)
-    return render_template('/users/show.html', user=user, messages=user.likes, likes=[m.id for m in g.user.likes])
+    messages = batch_loader().prime(archive.liked_messages(user.id), 'user')
+    return render_template('/users/show.html', user=user, messages=messages, likes=[m.id for m in g.user.likes])
 
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
@@ -224,14 +620,20 @@ def add_like(message_id):
     if not g.user:
         flash("Access unathorized.", "danger")
         return redirect('/')
-    like = Likes.query.filter(Likes.user_id == g.user.id, Likes.message_id == message_id).one_or_none()
+    like = hot_queries.run('user_like', g.user.id, message_id)
     if like:
         db.session.delete(like)
         db.session.commit()
+        trending.record_unlike(message_id)
     else:
+        msg = cache.get(Message, message_id)
+        if msg is None:
+            abort(404)
         new_like = Likes(user_id=g.user.id, message_id=message_id)
         db.session.add(new_like)
+        notifications.notify(msg.user_id, notifications.LIKE, g.user.id, message_id)
         db.session.commit()
+        trending.record_like(message_id)
     return redirect(request.referrer)
 
 
@@ -244,7 +646,14 @@ def profile():
     
     form = UserEditForm(obj=g.user)
     if form.validate_on_submit():
+        taken = availability.taken(g.user.id, username=form.username.data, email=form.email.data)
+        if taken:
+            for field in taken:
+                flash(f"{form[field].label.text} already taken", 'danger')
+            return render_template('users/edit.html', form=form)
+
         if User.authenticate(g.user.username, form.password.data):
+            old = {'username': g.user.username, 'email': g.user.email}
             g.user.username = form.username.data
             g.user.email = form.email.data
             g.user.image_url = form.image_url.data
@@ -252,7 +661,15 @@ def profile():
             g.user.bio = form.bio.data
             g.user.location = form.location.data
             db.session.add(g.user)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                flash("Username or e-mail already taken", 'danger')
+                return render_template('users/edit.html', form=form)
+            availability.remove(**{field: value for field, value in old.items()
+                                   if value != getattr(g.user, field)})
+            availability.add(g.user.id, username=g.user.username, email=g.user.email)
             flash(f"Successfully updated {g.user.username}", "success")
             return redirect(f"/users/{g.user.id}")
         else:
@@ -261,6 +678,55 @@ def profile():
     return render_template('users/edit.html', form=form)
 
 
+@app.route('/users/available')
+def check_available():
+    """Is a username and/or e-mail free to use? For live checks on the
+    signup and profile forms.
+
+    Takes 'username' and/or 'email' params in querystring; returns
+    {"username": true, "email": false} for the ones given. The logged-in
+    user's own username and e-mail count as available. E-mail is only
+    checked for logged-in users, so the endpoint can't be used to find
+    out who has an account, and they're rate limited per account as well
+    as per IP; signup still refuses a taken e-mail.
+    """
+
+    fields = ('username', 'email') if g.user else ('username',)
+    values = {field: request.args[field] for field in fields if request.args.get(field)}
+    user_id = g.user.id if g.user else None
+
+    if 'email' in values and app.config['RATELIMIT_ENABLED']:
+        wait = limiter.check('check_available_email', user_id, request.remote_addr)
+        if wait:
+            return too_busy("Too many requests. Please slow down and try again.", 429, wait)
+
+    return jsonify({field: availability.is_available(field, value, user_id)
+                    for field, value in values.items()})
+
+
+@app.route('/users/export')
+def export_data():
+    """Download the current user's profile, messages, likes and follows.
+
+    Takes a 'format' param in querystring: 'ndjson' (default) or 'csv'.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        flash("Unknown export format.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
+    generate, mimetype = export.FORMATS[fmt]
+    filename = f"warbler-{g.user.username}.{fmt}"
+
+    return Response(stream_with_context(generate(g.user.id)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
@@ -271,8 +737,12 @@ def delete_user():
 
     do_logout()
 
+    names = {'username': g.user.username, 'email': g.user.email}
+    for model in (Message, ArchivedMessage):
+        archive.forget_messages(db.session.query(model.id).filter(model.user_id == g.user.id))
     db.session.delete(g.user)
     db.session.commit()
+    availability.remove(**names)
 
     return redirect("/signup")
 
@@ -294,20 +764,153 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        # insert directly rather than through g.user.messages, which
+        # would load the user's whole messages collection. Group commit
+        # indexes hashtags in the batch's own transaction.
+        if app.config['GROUP_COMMIT']:
+            msg = Message(**message_committer.submit(db.engine, {'text': form.text.data, 'user_id': g.user.id}))
+        else:
+            msg = Message(text=form.text.data, user_id=g.user.id)
+            db.session.add(msg)
+            db.session.flush()
+            hashtags.index_message(msg)
+            db.session.commit()
+
+        publish_message(msg, g.user)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+def publish_message(msg, author):
+    """Push a newly committed message to followers' open timelines."""
+
+    html = render_template('messages/_timeline_item.html', msg=msg, author=author)
+    broker.publish(f"author:{author.id}", {'id': msg.id, 'user_id': author.id, 'html': html})
+
+
+@app.route('/timeline/stream')
+def timeline_stream():
+    """Server-Sent Events stream of new messages from followed users."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    subscription = broker.subscribe([f"author:{user.id}" for user in g.user.following])
+    keepalive = app.config['STREAM_KEEPALIVE']
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+@app.route('/messages/import', methods=["POST"])
+def messages_import():
+    """Bulk-import messages for the current user.
+
+    Request body is NDJSON: one {"text": ..., "timestamp": ...} per line.
+    Responds with JSON counts of imported and rejected lines.
+    """
+
+    if not g.user:
+        return jsonify({'error': "Access unauthorized."}), 401
+
+    return jsonify(importer.import_messages(g.user.id, request.stream))
+
+
+@app.cli.command('import-messages')
+@click.argument('username')
+@click.argument('file', type=click.File('rb'))
+def import_messages_command(username, file):
+    """Import an NDJSON FILE of messages for USERNAME."""
+
+    user = User.query.filter_by(username=username).one()
+    result = importer.import_messages(user.id, file)
+
+    click.echo(f"Imported {result['imported']} messages, rejected {result['rejected']}.")
+    for error in result['errors']:
+        click.echo(f"  line {error['line']}: {error['reason']}")
+
+
+@app.cli.command('import-follows')
+@click.argument('username')
+@click.argument('file', type=click.File('rb'))
+def import_follows_command(username, file):
+    """Have USERNAME follow the users listed in FILE, one username per line."""
+
+    user = User.query.filter_by(username=username).one()
+    result = follows.import_follows(user.id, file)
+
+    click.echo(f"Followed {result['followed']} users, {result['already_following']} already followed, "
+               f"{result['not_found']} not found.")
+    for missing in result['missing']:
+        click.echo(f"  not found: {missing}")
+
+
+@app.cli.command('archive-messages')
+@click.option('--months', default=12, help="Archive messages older than this many months.")
+@click.option('--detach-months', type=int, help="Also detach archive partitions older than this.")
+def archive_messages_command(months, detach_months):
+    """Move old messages into the monthly-partitioned archive."""
+
+    cutoff = archive.months_before(datetime.utcnow(), months)
+    click.echo(f"Archived {archive.archive_messages(cutoff)} messages older than {cutoff:%Y-%m-%d}.")
+
+    # have the next couple of months' partitions ready for later runs
+    archive.ensure_partitions(cutoff, archive.months_before(cutoff, -2))
+
+    if detach_months is not None:
+        for name in archive.detach_partitions(archive.months_before(cutoff, detach_months)):
+            click.echo(f"Detached {name}.")
+
+
+@app.cli.command('bench-prepared')
+@click.option('--iterations', default=1000)
+def bench_prepared_command(iterations):
+    """Time each hot query prepared and unprepared on the current database.
+
+    Run against a seeded database (python seed.py).
+    """
+
+    follow = Follows.query.first()
+    like = Likes.query.first()
+    if not follow:
+        raise click.ClickException("Seed the database first.")
+
+    user_id = follow.user_following_id
+    params = {
+        'user_by_id': (user_id,),
+        'home_timeline': (user_id, 100),
+        'user_messages': (follow.user_being_followed_id, 100),
+        'user_like': (like.user_id, like.message_id) if like else (user_id, 0),
+    }
+
+    for name, args in params.items():
+        result = hot_queries.benchmark(name, args, iterations)
+        click.echo(f"{name:15} unprepared {result['unprepared'] * 1000:8.3f} ms"
+                   f"   prepared {result['prepared'] * 1000:8.3f} ms")
+
+    hot_queries.enabled = app.config['PREPARED_STATEMENTS']
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = cache.get(Message, message_id) or ArchivedMessage.query.filter_by(id=message_id).first()
     return render_template('messages/show.html', message=msg)
 
 
@@ -315,18 +918,319 @@ def messages_show(message_id):
 def messages_destroy(message_id):
     """Delete a message."""
     
-    msg = Message.query.get(message_id)
+    msg = archive.get_message(message_id)
 
     if g.user != msg.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    hashtags.unindex_message(message_id)
+    archive.forget_messages([message_id])
     db.session.delete(msg)
     db.session.commit()
+    trending.forget(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/explore')
+def explore():
+    """Show trending messages, ranked by recent like velocity."""
+
+    ranked = [message_id for message_id, score in trending.top(100)]
+    by_id = {msg.id: msg for msg in Message.query.filter(Message.id.in_(ranked)).all()} if ranked else {}
+    messages = batch_loader().prime([by_id[message_id] for message_id in ranked if message_id in by_id], 'user')
+    likes = [m.id for m in g.user.likes] if g.user else []
+
+    return render_template('messages/feed.html', title="Trending", messages=messages, likes=likes,
+                           empty="Nothing is trending right now")
+
+
+@app.route('/tags/<tag>')
+def tag_feed(tag):
+    """Show the most recent messages tagged #tag."""
+
+    messages = batch_loader().prime(hashtags.term_feed(f"#{tag}"), 'user')
+    likes = [m.id for m in g.user.likes] if g.user else []
+
+    return render_template('messages/feed.html', title=f"#{tag}", messages=messages, likes=likes,
+                           empty=f"No messages tagged #{tag} yet")
+
+
+@app.route('/users/mentions')
+def show_mentions():
+    """Show the most recent messages mentioning the current user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    messages = batch_loader().prime(hashtags.term_feed(f"@{g.user.username}"), 'user')
+
+    return render_template('messages/feed.html', title="Mentions", messages=messages,
+                           likes=[m.id for m in g.user.likes], empty="Nobody has mentioned you yet")
+
+
+@app.route('/users/notifications')
+def show_notifications():
+    """Show the current user's latest likes and new followers, and mark
+    them all read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    events = notifications.recent(g.user.id)
+    batch_loader().prime(events, 'actor')
+    batch_loader().prime(events, 'message')
+
+    notifications.mark_read(g.user.id)
+    db.session.commit()
+
+    return render_template('users/notifications.html', events=events)
+
+
+@app.template_global()
+def unread_notifications():
+    if not g.user:
+        return 0
+    return notifications.unread_count(g.user.id)
+
+
+@app.cli.command('migrate-message-ids')
+@click.option('--batch-size', default=id_migration.BATCH_SIZE)
+@click.option('--force', is_flag=True, help="Run even if other sessions are connected.")
+def migrate_message_ids_command(batch_size, force):
+    """Give existing messages time-sortable ids and move message
+    timestamps to a server-side default. Stop the app first."""
+
+    try:
+        migrated = id_migration.migrate(batch_size, force)
+    except id_migration.DatabaseInUse as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f"Gave {migrated} messages new ids.")
+
+
+@app.cli.command('migrate-likes')
+def migrate_likes_command():
+    """Make likes unique per user and message rather than per message."""
+
+    for name in likes_migration.migrate():
+        click.echo(f"Dropped {name}.")
+    click.echo("Likes are unique per (user_id, message_id).")
+
+
+@app.cli.command('compact-notifications')
+@click.option('--days', default=lambda: app.config['NOTIFICATIONS_COMPACT_DAYS'], type=int,
+              show_default="NOTIFICATIONS_COMPACT_DAYS")
+def compact_notifications_command(days):
+    """Collapse notifications older than DAYS into aggregates."""
+
+    removed = notifications.compact(timedelta(days=days))
+    click.echo(f"Compacted {removed['likes']} like and {removed['follows']} follow notifications.")
+
+
+@app.cli.command('bench-streaming')
+@click.option('--iterations', default=20)
+def bench_streaming_command(iterations):
+    """Compare time to first byte and bytes sent for the streamed pages,
+    rendered whole or streamed, and uncompressed or compressed.
+
+    Run against a seeded database (python seed.py).
+    """
+
+    follow = Follows.query.first()
+    if not follow:
+        raise click.ClickException("Seed the database first.")
+
+    paths = ['/', f"/users/{follow.user_being_followed_id}", '/users']
+    encodings = ['identity'] + [encoder.name for encoder in reversed(streaming.encoders())]
+    saved = app.config['STREAM_TEMPLATES'], app.config['COMPRESS_RESPONSES']
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = follow.user_following_id
+
+    try:
+        for path in paths:
+            click.echo(path)
+            for stream in (False, True):
+                for encoding in encodings:
+                    app.config['STREAM_TEMPLATES'] = stream
+                    app.config['COMPRESS_RESPONSES'] = encoding != 'identity'
+
+                    first_byte = total = size = 0
+                    for _ in range(iterations):
+                        start = time.perf_counter()
+                        resp = client.get(path, headers={'Accept-Encoding': encoding})
+                        chunks = iter(resp.response)
+                        size += len(next(chunks, b''))
+                        first_byte += time.perf_counter() - start
+                        size += sum(len(chunk) for chunk in chunks)
+                        total += time.perf_counter() - start
+                        resp.close()
+
+                    label = f"{'streamed' if stream else 'whole':8} {encoding:8}"
+                    click.echo(f"  {label} first byte {first_byte / iterations * 1000:8.2f} ms"
+                               f"   total {total / iterations * 1000:8.2f} ms"
+                               f"   {size // iterations:8} bytes")
+    finally:
+        app.config['STREAM_TEMPLATES'], app.config['COMPRESS_RESPONSES'] = saved
+
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=20, help="Show this many statements.")
+@click.option('--plans/--no-plans', default=False, help="Show the latest plan for each.")
+@click.option('--file', 'path', default=lambda: app.config['SLOW_QUERY_LOG_PATH'], show_default="SLOW_QUERY_LOG_PATH")
+def slow_queries_command(top, plans, path):
+    """Summarize the slow-query log by statement, most total time first."""
+
+    summary = slowlog.summarize(slowlog.read_entries(path))
+    if not summary:
+        raise click.ClickException(f"No slow queries logged in {path}.")
+
+    for group in summary[:top]:
+        endpoints = ', '.join(f"{endpoint} ({count})" for endpoint, count in group['endpoints'].items())
+        click.echo(f"{group['fingerprint']}  {group['count']:6}x  total {group['total']:9.3f} s  "
+                   f"mean {group['mean'] * 1000:9.1f} ms  max {group['max'] * 1000:9.1f} ms")
+        click.echo(f"    {group['statement'][:300]}")
+        click.echo(f"    endpoints: {endpoints}   last seen {group['last_seen']}")
+        if plans and group['plan']:
+            for line in group['plan'].splitlines():
+                click.echo(f"      {line}")
+
+
+@app.cli.command('analytics-export')
+@click.option('--dir', 'directory', default='analytics-data', help="Where to write the column files.")
+def analytics_export_command(directory):
+    """Copy follows, likes and messages into NumPy column files."""
+
+    import analytics
+
+    for table, rows in analytics.export_tables(directory).items():
+        click.echo(f"{table:10} {rows} rows")
+
+
+@app.cli.command('analytics-report')
+@click.option('--dir', 'directory', default='analytics-data', help="Column files from analytics-export.")
+@click.option('--samples', default=1000000, help="Triples sampled to estimate clustering.")
+@click.option('--json', 'as_json', is_flag=True, help="Print the report as JSON.")
+def analytics_report_command(directory, samples, as_json):
+    """Degree distribution, reciprocity, clustering and engagement."""
+
+    import analytics
+
+    result = analytics.report(directory, samples)
+    if as_json:
+        click.echo(json.dumps(result, indent=2))
+        return
+
+    click.echo(f"Exported {result['exported_at']}: {result['users']} users, "
+               f"{result['rows']['follows']} follows, {result['rows']['likes']} likes, "
+               f"{result['rows']['messages']} messages")
+
+    for name in ('out_degree', 'in_degree'):
+        stats = result[name]
+        click.echo(f"{name:11} mean {stats['mean']:.2f}  p50 {stats['p50']:g}  p90 {stats['p90']:g}"
+                   f"  p99 {stats['p99']:g}  max {stats['max']}")
+        for bucket, count in stats['histogram'].items():
+            click.echo(f"    {bucket:>15} {count}")
+
+    click.echo(f"reciprocity {result['reciprocity']:.4f}")
+    click.echo(f"clustering  {result['clustering']:.4f} (estimated from {samples} triples)")
+
+    engagement = result['engagement']
+    click.echo(f"likes/message mean {engagement['likes_per_message']['mean']:.3f}  "
+               f"max {engagement['likes_per_message']['max']}  "
+               f"liked {engagement['liked_share']:.1%}")
+    for top in engagement['top']:
+        click.echo(f"    message {top['message_id']}: {top['likes']} likes")
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a fingerprinted static file, compressed if the client accepts
+    it. The name changes whenever the content does, so it's cached forever."""
+
+    name, encoding = assets.variant(filename, request.headers.get('Accept-Encoding', ''))
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    resp = send_from_directory(assets.dist_dir, name, mimetype=mimetype)
+    resp.headers['Cache-Control'] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+
+@app.template_global()
+def asset_url(path):
+    return assets.url(path)
+
+
+@app.route('/images/<size>/<signature>')
+def image(size, signature):
+    """Serve a user's avatar or header image, resized to `size`, from the
+    image cache (fetching it first if it isn't there yet)."""
+
+    source = request.args.get('u', '')
+    if not imageproxy.verify(app.config['SECRET_KEY'], size, source, signature):
+        abort(404)
+
+    try:
+        path, mimetype, etag = images.get(source, size)
+    except ImageFetchError:
+        abort(502)
+
+    resp = send_file(path, mimetype=mimetype)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = f"public, max-age={IMAGE_MAX_AGE}"
+    # never let a browser treat a cached file as anything but an image
+    resp.headers['X-Content-Type-Options'] = 'nosniff'
+    resp.headers['Content-Security-Policy'] = "default-src 'none'; sandbox"
+    return resp.make_conditional(request)
+
+
+@app.template_filter('thumbnail')
+def thumbnail_filter(url, size):
+    if not url:
+        return url
+    return imageproxy.proxy_url(url, size, app.config['SECRET_KEY'])
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write fingerprinted, compressed copies of static/ to static/dist/."""
+
+    manifest = build_assets()
+    assets.load()
+    click.echo(f"Built {len(manifest)} assets into {assets.dist_dir}.")
+
+
+@app.template_filter('link_terms')
+def link_terms_filter(text):
+    return hashtags.link_terms(text)
+
+
+@app.cli.command('backfill-terms')
+@click.option('--batch-size', default=hashtags.BACKFILL_BATCH_SIZE)
+@click.option('--workers', type=int, help="Tokenizer processes (default: one per CPU).")
+def backfill_terms_command(batch_size, workers):
+    """Rebuild the #tag/@mention index for all messages."""
+
+    click.echo(f"Indexed {hashtags.backfill(batch_size, workers)} messages.")
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Hit and miss counts for the user/message cache."""
+
+    if not g.user:
+        return jsonify({'error': "Access unauthorized."}), 401
+
+    return jsonify(cache.stats())
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -335,22 +1239,25 @@ def messages_destroy(message_id):
 def homepage():
     """Show homepage:
 
-    - anon users: no messages
+    - anon users: the shared public timeline of the latest messages
     - logged in: 100 most recent messages of followed_users
     """
 
     if g.user:
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_([user.id for user in g.user.following]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = LazyList(lambda: batch_loader().prime(hot_queries.run('home_timeline', g.user.id, 100), 'user'))
 
-        return render_template('home.html', messages=messages, likes=[m.id for m in g.user.likes])
+        return render_page('home.html', snapshot=True, messages=messages, likes=[m.id for m in g.user.likes])
 
     else:
-        return render_template('home-anon.html')
+        # a page showing flashed messages is only for this visitor
+        shared = '_flashes' not in session
+        snapshot = public_timeline.get()
+        timeline = Markup(snapshot['html']) if snapshot else None
+
+        resp = make_response(render_template('home-anon.html', timeline=timeline))
+        if shared:
+            resp.headers['Cache-Control'] = f"public, max-age={app.config['PUBLIC_TIMELINE_TTL']}"
+        return resp
 
 
 ##############################################################################
@@ -360,9 +1267,22 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
+@app.after_request
+def compress(resp):
+    """gzip or brotli-encode responses for clients that accept it."""
+
+    if app.config['COMPRESS_RESPONSES']:
+        compress_response(resp, request.headers.get('Accept-Encoding', ''))
+    return resp
+
+
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request except static files and
+    responses that set their own caching."""
+
+    if request.endpoint in STATIC_ENDPOINTS or 'Cache-Control' in req.headers:
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
@@ -0,0 +1,199 @@
+"""Hot/cold tiering of messages.
+
+Recent messages live in `messages`, which stays small so the timeline
+indexes stay small. The archive job moves messages older than a cutoff
+into `messages_archive`. On Postgres that table is partitioned by month,
+so old months can be detached as standalone tables.
+
+Likes, trending counts and notification events refer to a message by
+id in either tier, so they have no foreign key to `messages.id` and stay
+in place when a message moves; `forget_messages` removes them when a
+message is deleted.
+
+The lookup helpers below read both tiers, so pages keep working for
+archived messages.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from models import db, Message, ArchivedMessage, Likes, TrendingCount, NotificationEvent
+from prepared import hot_queries
+
+BATCH_SIZE = 5000
+
+# tables whose message_id may point at either tier
+MESSAGE_REFERENCES = (Likes, TrendingCount, NotificationEvent)
+
+
+def get_message(message_id):
+    """Message with this id from either tier, or None."""
+
+    return (Message.query.get(message_id)
+            or ArchivedMessage.query.filter_by(id=message_id).first())
+
+
+def newest_first(messages, limit):
+    return sorted(messages, key=lambda m: (m.timestamp, m.id), reverse=True)[:limit]
+
+
+def user_messages(user_id, limit=100):
+    """A user's `limit` most recent messages from both tiers, newest first.
+
+    Imported messages can land in the hot table with old timestamps, so
+    the tiers are merged by timestamp rather than appended.
+    """
+
+    hot = hot_queries.run('user_messages', user_id, limit)
+    cold = (ArchivedMessage
+            .query
+            .filter(ArchivedMessage.user_id == user_id)
+            .order_by(ArchivedMessage.timestamp.desc(), ArchivedMessage.id.desc())
+            .limit(limit)
+            .all())
+
+    return newest_first(hot + cold, limit)
+
+
+def liked_messages(user_id):
+    """Messages `user_id` has liked, from both tiers, latest like first."""
+
+    ids = [id for (id,) in (db.session
+                            .query(Likes.message_id)
+                            .filter(Likes.user_id == user_id)
+                            .order_by(Likes.id.desc()))]
+    if not ids:
+        return []
+
+    found = {m.id: m for m in Message.query.filter(Message.id.in_(ids))}
+    found.update((m.id, m) for m in ArchivedMessage.query.filter(ArchivedMessage.id.in_(ids)))
+    return [found[id] for id in ids if id in found]
+
+
+def forget_messages(message_ids):
+    """Delete likes, trending counts and notification events for
+    `message_ids` (a list or a query of ids), which are being deleted.
+    Doesn't commit."""
+
+    for model in MESSAGE_REFERENCES:
+        model.query.filter(model.message_id.in_(message_ids)).delete(synchronize_session=False)
+
+
+def drop_message_foreign_keys():
+    """Drop foreign keys from MESSAGE_REFERENCES to `messages`, left by
+    databases created before messages could be archived with their
+    likes. Returns the dropped constraint names."""
+
+    if not is_postgres():
+        return []
+
+    inspector = inspect(db.session.get_bind())
+    dropped = []
+    for model in MESSAGE_REFERENCES:
+        table = model.__tablename__
+        for fk in inspector.get_foreign_keys(table):
+            if fk['referred_table'] == 'messages':
+                db.session.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{fk["name"]}"'))
+                dropped.append(fk['name'])
+
+    db.session.commit()
+    return dropped
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(when):
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+
+
+def months_before(when, months):
+    """Start of the month `months` months before `when`'s month."""
+
+    index = when.year * 12 + when.month - 1 - months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_archive_{month:%Y_%m}"
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def ensure_partitions(start, end):
+    """Create monthly archive partitions covering [start, end] (Postgres)."""
+
+    if not is_postgres():
+        return
+
+    month = month_start(start)
+    while month <= end:
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF messages_archive "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"))
+        month = next_month(month)
+
+    db.session.commit()
+
+
+def detach_partitions(before):
+    """Detach archive partitions for months before `before` (Postgres).
+
+    The detached tables keep their data and can be dumped or dropped
+    separately. Returns the detached table names.
+    """
+
+    if not is_postgres():
+        return []
+
+    rows = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = 'messages_archive'"))
+
+    detached = []
+    for (name,) in rows.fetchall():
+        if name < partition_name(month_start(before)):
+            db.session.execute(text(f"ALTER TABLE messages_archive DETACH PARTITION {name}"))
+            detached.append(name)
+
+    db.session.commit()
+    return detached
+
+
+def archive_messages(cutoff, batch_size=BATCH_SIZE):
+    """Move messages older than `cutoff` to the archive, one batch per
+    transaction. Returns the number of messages moved."""
+
+    oldest = db.session.query(db.func.min(Message.timestamp)).filter(Message.timestamp < cutoff).scalar()
+    if oldest is None:
+        return 0
+    # an old foreign key would cascade likes away as messages move
+    drop_message_foreign_keys()
+    ensure_partitions(oldest, cutoff)
+
+    columns = [Message.id, Message.text, Message.timestamp, Message.user_id]
+    moved = 0
+
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(Message.id)
+                                .filter(Message.timestamp < cutoff)
+                                .order_by(Message.id)
+                                .limit(batch_size))]
+        if not ids:
+            return moved
+
+        db.session.execute(ArchivedMessage.__table__.insert().from_select(
+            ['id', 'text', 'timestamp', 'user_id'],
+            db.session.query(*columns).filter(Message.id.in_(ids)).statement))
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        moved += len(ids)
@@ -0,0 +1,180 @@
+"""Fingerprinted, precompressed static assets.
+
+`build` copies every file under static/ into static/dist/ with a hash of
+its contents in the name (style.css -> style.3b5d0c1e9a7f.css), writes
+gzip and brotli versions of the compressible ones, and records the names
+in static/dist/manifest.json. Templates link to assets through
+`asset_url`, which looks the hashed name up in the manifest, so a changed
+file gets a new URL and the old one can be cached forever.
+
+Hashed files are served from /assets/ with far-future immutable cache
+headers, picking the .br or .gz variant the browser accepts. Until
+`flask build-assets` has been run, `asset_url` falls back to the plain
+/static/ URL.
+
+Brotli variants need the optional `brotli` package; without it only
+gzip variants are written.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIRNAME = 'dist'
+MANIFEST_NAME = 'manifest.json'
+URL_PREFIX = '/assets/'
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.map'}
+
+# preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_URL_RE = re.compile(r'''url\((['"]?)/static/([^'")]+)\1\)''')
+
+
+def fingerprint(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def hashed_name(path, content):
+    """'stylesheets/style.css' -> 'stylesheets/style.<hash>.css'"""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{fingerprint(content)}{ext}"
+
+
+def source_files(static_dir):
+    """Paths relative to `static_dir` of every file outside dist/."""
+
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        if dirpath == static_dir and DIST_DIRNAME in dirnames:
+            dirnames.remove(DIST_DIRNAME)
+        for filename in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, filename), static_dir).replace(os.sep, '/')
+
+
+def compressors():
+    """[(suffix, compress function)] for the encodings available here."""
+
+    available = [('.gz', lambda content: gzip.compress(content, compresslevel=9, mtime=0))]
+    try:
+        import brotli
+    except ImportError:
+        return available
+    return [('.br', lambda content: brotli.compress(content, quality=11))] + available
+
+
+def rewrite_css_urls(css, manifest):
+    """Point url(/static/...) references in `css` at their hashed names."""
+
+    def replace(match):
+        quote, path = match.groups()
+        if path not in manifest:
+            return match.group(0)
+        return f"url({quote}{URL_PREFIX}{manifest[path]}{quote})"
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def accepted_encodings(header):
+    """Content codings named in an Accept-Encoding header, minus q=0 ones."""
+
+    accepted = set()
+    for item in header.split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        refused = False
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    refused = float(param[2:]) == 0
+                except ValueError:
+                    pass
+        if coding and not refused:
+            accepted.add(coding.lower())
+    return accepted
+
+
+def build(static_dir=STATIC_DIR):
+    """Write hashed and compressed copies of the static files; returns the
+    manifest of {source path: hashed path}.
+
+    CSS is hashed after its url(/static/...) references have been
+    rewritten to hashed names, so it's processed after everything else.
+    """
+
+    dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+    paths = sorted(source_files(static_dir), key=lambda path: path.endswith('.css'))
+    encoders = compressors()
+    manifest = {}
+
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as file:
+            content = file.read()
+
+        if path.endswith('.css'):
+            content = rewrite_css_urls(content.decode(), manifest).encode()
+
+        name = hashed_name(path, content)
+        manifest[path] = name
+
+        target = os.path.join(dist_dir, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as file:
+            file.write(content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            for suffix, compress in encoders:
+                compressed = compress(content)
+                if len(compressed) < len(content):
+                    with open(target + suffix, 'wb') as file:
+                        file.write(compressed)
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class AssetManifest:
+    """Maps static paths to their fingerprinted /assets/ URLs."""
+
+    def __init__(self, static_dir=STATIC_DIR):
+        self.static_dir = static_dir
+        self.dist_dir = os.path.join(static_dir, DIST_DIRNAME)
+        self.manifest = None
+
+    def load(self):
+        try:
+            with open(os.path.join(self.dist_dir, MANIFEST_NAME)) as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, path):
+        """URL for `path`, given relative to static/ or as '/static/...'."""
+
+        if self.manifest is None:
+            self.load()
+
+        if path.startswith('/static/'):
+            path = path[len('/static/'):]
+
+        if path in self.manifest:
+            return URL_PREFIX + self.manifest[path]
+        return '/static/' + path
+
+    def variant(self, filename, accept_encoding):
+        """(file name under dist/, content encoding or None) to send for
+        `filename` to a client sending `accept_encoding`."""
+
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(os.path.join(self.dist_dir, filename + suffix)):
+                return filename + suffix, encoding
+        return filename, None
+
+
+manifest = AssetManifest()
@@ -0,0 +1,146 @@
+"""Username and email availability checks backed by Bloom filters.
+
+Each worker keeps a Bloom filter of every username and every email, and
+an exact map from each of them to the id of the user that has it. Both
+are built from the users table the first time they're needed, rebuilt
+every MAX_AGE seconds, and updated as users sign up, change their
+profile or delete their account in this worker.
+
+A name the filter has never seen is free. A name it has seen and the map
+knows is taken by that user. Neither needs the database. Only a filter
+hit the map doesn't confirm (a false positive, or a name freed in this
+worker, which the filter can't forget) costs an indexed lookup. None of
+these need the password to be hashed first.
+
+Renames and deletions in other workers show up here at the next
+rebuild; until then their old names still read as taken. The unique
+constraints on users stay the final word: a name taken by another worker
+since this one last loaded is still caught as an IntegrityError on
+commit.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+from models import db, User
+
+FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 10000
+# seconds before the filters and owner maps are rebuilt from the database
+MAX_AGE = 300
+
+FIELDS = ('username', 'email')
+
+
+class BloomFilter:
+    """Fixed-size set membership test with false positives only."""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(value))
+
+
+class AvailabilityIndex:
+    """One Bloom filter and one value -> user id map per unique user field."""
+
+    def __init__(self, error_rate=FALSE_POSITIVE_RATE, max_age=MAX_AGE, clock=time.monotonic):
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.clock = clock
+        self.filters = None
+        self.owners = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def ensure_loaded(self):
+        """Build the filters and owner maps from the users table when they're
+        missing, older than `max_age` or full."""
+
+        if (self.filters is not None and self.clock() - self.loaded_at < self.max_age
+                and all(f.count <= f.capacity for f in self.filters.values())):
+            return
+
+        rows = db.session.query(User.id, User.username, User.email).all()
+        capacity = max(MIN_CAPACITY, 2 * len(rows))
+        filters = {field: BloomFilter(capacity, self.error_rate) for field in FIELDS}
+        owners = {field: {} for field in FIELDS}
+
+        for user_id, username, email in rows:
+            filters['username'].add(username)
+            filters['email'].add(email)
+            owners['username'][username] = user_id
+            owners['email'][email] = user_id
+
+        with self.lock:
+            self.filters = filters
+            self.owners = owners
+            self.loaded_at = self.clock()
+
+    def add(self, user_id, **values):
+        """Record values taken by `user_id`, e.g.
+        add(1, username='bob', email='bob@x.com')."""
+
+        self.ensure_loaded()
+        with self.lock:
+            for field, value in values.items():
+                if value:
+                    self.filters[field].add(value)
+                    self.owners[field][value] = user_id
+
+    def remove(self, **values):
+        """Record values that have been freed, e.g. a user's old username."""
+
+        self.ensure_loaded()
+        with self.lock:
+            for field, value in values.items():
+                self.owners[field].pop(value, None)
+
+    def is_available(self, field, value, user_id=None):
+        """Is `value` unused for `field`, other than by user `user_id`?"""
+
+        self.ensure_loaded()
+        if value not in self.filters[field]:
+            return True
+
+        owner = self.owners[field].get(value)
+        if owner is not None:
+            return owner == user_id
+
+        query = User.query.filter(getattr(User, field) == value)
+        if user_id is not None:
+            query = query.filter(User.id != user_id)
+        return not db.session.query(query.exists()).scalar()
+
+    def taken(self, user_id=None, **values):
+        """Names of the fields in `values` whose value is already in use."""
+
+        return [field for field, value in values.items()
+                if not self.is_available(field, value, user_id)]
+
+    def reset(self):
+        with self.lock:
+            self.filters = None
+            self.owners = None
+
+
+index = AvailabilityIndex()
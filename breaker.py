@@ -0,0 +1,122 @@
+"""Circuit breaker around the database.
+
+Every statement's duration is folded into a moving average. The breaker
+opens when that average goes over `latency_threshold`, once it covers at
+least `min_samples` statements, or after `error_threshold` database
+errors in a row. While it is open the app
+serves stale pages instead of queuing on the database; once `cooldown`
+seconds have passed, one request runs a probe query and closes the
+breaker if the database answers quickly again.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+
+class CircuitBreaker:
+    """Track database health and decide whether to send it traffic."""
+
+    def __init__(self, latency_threshold=1.0, error_threshold=5, cooldown=5,
+                 smoothing=0.1, min_samples=20, clock=time.monotonic):
+        self.latency_threshold = latency_threshold
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.min_samples = min_samples
+        self.clock = clock
+
+        self.state = CLOSED
+        self.latency = 0.0
+        self.samples = 0
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.latency += self.smoothing * (seconds - self.latency)
+            self.samples += 1
+            self.errors = 0
+            if self.samples >= self.min_samples and self.latency > self.latency_threshold:
+                self.trip()
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+            if self.errors >= self.error_threshold:
+                self.trip()
+
+    def trip(self):
+        """Open the breaker (call with the lock held, or from tests)."""
+
+        if self.state != OPEN:
+            self.state = OPEN
+            self.opened_at = self.clock()
+
+    def reset(self):
+        with self.lock:
+            self.state = CLOSED
+            self.latency = 0.0
+            self.samples = 0
+            self.errors = 0
+            self.opened_at = None
+            self.probing = False
+
+    def claim_probe(self):
+        """True for the one caller that should probe the database now."""
+
+        with self.lock:
+            if self.state != OPEN or self.probing or self.clock() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def probe(self, check):
+        """Time `check()`; close the breaker if it's quick, else wait another
+        cooldown. Return whether the breaker closed."""
+
+        start = self.clock()
+        try:
+            check()
+            elapsed = self.clock() - start
+        except Exception:
+            elapsed = None
+
+        with self.lock:
+            self.probing = False
+            if elapsed is not None and elapsed <= self.latency_threshold:
+                self.state = CLOSED
+                self.latency = elapsed
+                self.samples = 1
+                self.errors = 0
+                return True
+
+            self.opened_at = self.clock()
+            return False
+
+    def watch(self, target):
+        """Time every statement run by `target`, the app's Engine."""
+
+        @event.listens_for(target, 'before_cursor_execute')
+        def start_timer(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('breaker_start', []).append(self.clock())
+
+        @event.listens_for(target, 'after_cursor_execute')
+        def stop_timer(conn, cursor, statement, parameters, context, executemany):
+            self.record_latency(self.clock() - conn.info['breaker_start'].pop())
+
+        @event.listens_for(target, 'handle_error')
+        def drop_timer(context):
+            starts = context.connection.info.get('breaker_start') if context.connection else None
+            if starts:
+                starts.pop()
@@ -0,0 +1,266 @@
+"""Primary-key cache for User and Message lookups.
+
+Rows are cached as plain dicts of column values, so the same entries work
+in the in-process backend and in a shared backend used by several worker
+processes. A cached row is attached to the current session without a query
+(`session.merge(..., load=False)`), so relationships still lazy-load as
+usual. Columns in PRIVATE_COLUMNS (the password hash and email) are
+never cached; they load from the database if a cached row is asked for
+them.
+
+Entries are dropped once a transaction that updated or deleted a cached
+model through the ORM has committed. Dropping them at flush instead would
+let a concurrent request refill the cache with the old row before the
+change is visible to it.
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached, object_session
+
+from models import db
+
+# left out of cached rows
+PRIVATE_COLUMNS = frozenset({'password', 'email'})
+
+
+class LocalCache:
+    """In-process cache with a time-to-live and least-recently-used eviction.
+
+    With `maxbytes`, entries are also evicted to keep the total of
+    `sizeof(value)` under it.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, clock=time.monotonic, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value, size = entry
+            if expires <= self.clock():
+                self.discard(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            self.delete(key)
+            return
+
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (self.clock() + self.ttl, value, size)
+            self.bytes += size
+            while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """Remove `key`; the caller holds the lock."""
+
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+class LocalStore:
+    """Stand-in for a shared key/value server (the subset of the Redis API
+    that SharedCache uses), for development and tests."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            if nx and key in self.data and (self.data[key][1] is None or self.data[key][1] > time.time()):
+                return None
+            self.data[key] = (value, time.time() + ex if ex else None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        with self.lock:
+            value = int(self.data.get(key, (0, None))[0] or 0) + 1
+            self.data[key] = (value, None)
+            return value
+
+
+class SharedCache:
+    """Cache kept in a shared store such as Redis.
+
+    `clear()` bumps a generation number that is part of every key, so old
+    entries become unreachable and simply expire.
+    """
+
+    def __init__(self, client, ttl=300, prefix='warbler:cache'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def full_key(self, key):
+        generation = int(self.client.get(f"{self.prefix}:generation") or 0)
+        return f"{self.prefix}:{generation}:{key}"
+
+    def get(self, key):
+        value = self.client.get(self.full_key(key))
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.full_key(key), pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.full_key(key))
+
+    def clear(self):
+        self.client.incr(f"{self.prefix}:generation")
+
+
+class ModelCache:
+    """Cache primary-key lookups of models, counting hits and misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model, pk):
+        return f"{model.__name__}:{pk}"
+
+    def get(self, model, pk):
+        """Like `model.query.get(pk)`, answered from the cache when possible."""
+
+        data = self.backend.get(self.key(model, pk))
+
+        if data is None:
+            self.misses += 1
+            instance = model.query.get(pk)
+            if instance is not None:
+                self.backend.set(self.key(model, pk), self.dump(instance))
+            return instance
+
+        self.hits += 1
+        return self.load(model, data)
+
+    def get_or_404(self, model, pk):
+        instance = self.get(model, pk)
+        if instance is None:
+            abort(404)
+        return instance
+
+    def dump(self, instance):
+        return {attr.key: getattr(instance, attr.key)
+                for attr in inspect(instance).mapper.column_attrs
+                if attr.key not in PRIVATE_COLUMNS}
+
+    def load(self, model, data):
+        instance = model(**data)
+        make_transient_to_detached(instance)
+        return db.session.merge(instance, load=False)
+
+    def invalidate(self, model, pk):
+        self.backend.delete(self.key(model, pk))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'miss_ratio': self.misses / lookups if lookups else 0.0,
+        }
+
+    def watch(self, *models):
+        """Invalidate entries when a transaction changing instances of
+        `models` commits."""
+
+        # keys to drop on commit, kept per cache in case there are several
+        def stale(session):
+            return session.info.setdefault(self, set())
+
+        def drop(mapper, connection, target):
+            session = object_session(target)
+            key = (mapper.class_, mapper.primary_key_from_instance(target)[0])
+            if session is None:
+                self.invalidate(*key)
+            else:
+                stale(session).add(key)
+
+        for model in models:
+            event.listen(model, 'after_update', drop)
+            event.listen(model, 'after_delete', drop)
+
+        def drop_all(context):
+            if context.mapper.class_ in models:
+                stale(context.session).add(None)
+
+        # Query.update() / Query.delete() don't say which rows changed
+        event.listen(db.session, 'after_bulk_update', drop_all)
+        event.listen(db.session, 'after_bulk_delete', drop_all)
+
+        def after_commit(session):
+            keys = session.info.pop(self, ())
+            if None in keys:
+                self.backend.clear()
+                return
+            for key in keys:
+                self.invalidate(*key)
+
+        def after_rollback(session):
+            session.info.pop(self, None)
+
+        event.listen(db.session, 'after_commit', after_commit)
+        event.listen(db.session, 'after_rollback', after_rollback)
+
+
+def make_backend(config):
+    """Build the cache backend named by `config['CACHE_BACKEND']`."""
+
+    ttl = config['CACHE_TTL']
+
+    if config['CACHE_BACKEND'] != 'shared':
+        return LocalCache(maxsize=config['CACHE_MAXSIZE'], ttl=ttl)
+
+    if config.get('CACHE_REDIS_URL'):
+        import redis
+        return SharedCache(redis.Redis.from_url(config['CACHE_REDIS_URL']), ttl=ttl)
+
+    return SharedCache(LocalStore(), ttl=ttl)
@@ -0,0 +1,91 @@
+"""Streaming export of a user's personal data as NDJSON or CSV.
+
+Rows are read as plain column tuples with `yield_per`, which streams them
+through a server-side cursor on Postgres, so the export runs in fixed
+memory however many messages the account has and no Message objects are
+loaded into the session.
+"""
+
+import csv
+import io
+import json
+
+from models import db, User, Message, ArchivedMessage, Likes, Follows
+
+BATCH_SIZE = 1000
+
+CSV_FIELDS = ['type', 'id', 'username', 'email', 'image_url', 'header_image_url',
+              'bio', 'location', 'text', 'timestamp', 'user_id', 'message_id']
+
+
+def export_records(user_id):
+    """Yield one dict per exported item: the profile, then messages, likes,
+    followed users and followers."""
+
+    profile = (db.session
+               .query(User.id, User.username, User.email, User.image_url,
+                      User.header_image_url, User.bio, User.location)
+               .filter(User.id == user_id)
+               .one())
+    yield dict(profile._asdict(), type='profile')
+
+    messages = (db.session
+                .query(Message.id, Message.text, Message.timestamp)
+                .filter(Message.user_id == user_id)
+                .order_by(Message.id)
+                .yield_per(BATCH_SIZE))
+    for id, text, timestamp in messages:
+        yield {'type': 'message', 'id': id, 'text': text, 'timestamp': timestamp.isoformat()}
+
+    archived = (db.session
+                .query(ArchivedMessage.id, ArchivedMessage.text, ArchivedMessage.timestamp)
+                .filter(ArchivedMessage.user_id == user_id)
+                .order_by(ArchivedMessage.id)
+                .yield_per(BATCH_SIZE))
+    for id, text, timestamp in archived:
+        yield {'type': 'message', 'id': id, 'text': text, 'timestamp': timestamp.isoformat()}
+
+    likes = (db.session
+             .query(Likes.message_id)
+             .filter(Likes.user_id == user_id)
+             .order_by(Likes.id)
+             .yield_per(BATCH_SIZE))
+    for (message_id,) in likes:
+        yield {'type': 'like', 'message_id': message_id}
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id)
+                 .yield_per(BATCH_SIZE))
+    for (followed_id,) in following:
+        yield {'type': 'following', 'user_id': followed_id}
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user_id)
+                 .yield_per(BATCH_SIZE))
+    for (follower_id,) in followers:
+        yield {'type': 'follower', 'user_id': follower_id}
+
+
+def export_ndjson(user_id):
+    for record in export_records(user_id):
+        yield json.dumps(record) + '\n'
+
+
+def export_csv(user_id):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+
+    for record in export_records(user_id):
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+FORMATS = {
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv'),
+}
@@ -0,0 +1,143 @@
+"""Follow and unfollow as single-statement writes, and bulk follows.
+
+Going through `user.following.append()` / `.remove()` loads the follower's
+whole following collection to change one row. These functions write the
+`follows` rows directly instead: following is an idempotent insert (ON
+CONFLICT DO NOTHING on Postgres) and unfollowing a delete, so their cost
+doesn't grow with the number of accounts a user follows. Collections
+already loaded in the session are expired rather than updated.
+
+`follow_users` follows many users at once, a batch per transaction, and
+`import_follows` does the same for a file of usernames, one per line.
+"""
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm.util import identity_key
+
+from models import db, User, Follows
+
+BATCH_SIZE = 1000
+MAX_ERRORS = 100
+
+table = Follows.__table__
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def expire_collections(follower_id, user_ids):
+    """Make loaded following/followers collections reload on next use."""
+
+    for user_id, attr in [(follower_id, 'following')] + [(user_id, 'followers') for user_id in user_ids]:
+        user = db.session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            db.session.expire(user, [attr])
+
+
+def add_follows(follower_id, user_ids):
+    """Have `follower_id` follow each of `user_ids`, skipping any already
+    followed; returns the number of follows added. Doesn't commit."""
+
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return 0
+
+    if is_postgres():
+        rows = [{'user_following_id': follower_id, 'user_being_followed_id': user_id} for user_id in user_ids]
+        added = db.session.execute(pg_insert(table).values(rows).on_conflict_do_nothing()).rowcount
+    else:
+        existing = {row[0] for row in db.session.query(table.c.user_being_followed_id)
+                    .filter(table.c.user_following_id == follower_id)
+                    .filter(table.c.user_being_followed_id.in_(user_ids))}
+        rows = [{'user_following_id': follower_id, 'user_being_followed_id': user_id}
+                for user_id in user_ids if user_id not in existing]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        added = len(rows)
+
+    expire_collections(follower_id, user_ids)
+    return added
+
+
+def remove_follows(follower_id, user_ids):
+    """Have `follower_id` stop following `user_ids`; returns the number of
+    follows removed. Doesn't commit."""
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+
+    removed = db.session.execute(
+        table.delete()
+        .where(table.c.user_following_id == follower_id)
+        .where(table.c.user_being_followed_id.in_(user_ids))).rowcount
+
+    expire_collections(follower_id, user_ids)
+    return removed
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def follow_users(follower_id, user_ids, batch_size=BATCH_SIZE):
+    """Follow every existing user in `user_ids`, committing a batch at a time.
+
+    Returns counts of users newly followed, already followed and not
+    found (unknown ids, and the follower themselves).
+    """
+
+    user_ids = list(dict.fromkeys(user_ids))
+    candidates = [user_id for user_id in user_ids if user_id != follower_id]
+    followed = found = 0
+
+    for batch in batches(candidates, batch_size):
+        existing = [row[0] for row in db.session.query(User.id).filter(User.id.in_(batch))]
+        followed += add_follows(follower_id, existing)
+        found += len(existing)
+        db.session.commit()
+
+    return {
+        'followed': followed,
+        'already_following': found - followed,
+        'not_found': len(user_ids) - found,
+    }
+
+
+def parse_usernames(lines):
+    """Usernames from `lines`, one per line; blank lines are skipped and a
+    leading @ is dropped."""
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        username = line.strip().lstrip('@')
+        if username:
+            yield username
+
+
+def import_follows(follower_id, lines, batch_size=BATCH_SIZE):
+    """Follow the users named in `lines` (see `parse_usernames`).
+
+    Returns the counts from `follow_users`, plus the first MAX_ERRORS
+    usernames that weren't found.
+    """
+
+    usernames = list(dict.fromkeys(parse_usernames(lines)))
+    result = {'followed': 0, 'already_following': 0, 'not_found': 0}
+    missing = []
+
+    for batch in batches(usernames, batch_size):
+        ids = dict(db.session.query(User.username, User.id).filter(User.username.in_(batch)))
+        counts = follow_users(follower_id, list(ids.values()), batch_size)
+
+        for key in result:
+            result[key] += counts[key]
+        unknown = [username for username in batch if username not in ids]
+        result['not_found'] += len(unknown)
+        missing.extend(unknown[:MAX_ERRORS - len(missing)])
+
+    result['missing'] = missing
+    return result
@@ -0,0 +1,110 @@
+"""Group commit for bursts of inserts into a single table.
+
+The first caller to arrive becomes the leader: it waits a few milliseconds
+for other callers in this process to queue their rows, then inserts the
+whole batch in one transaction. Every caller blocks until the transaction
+holding its row has committed, so a request is only acknowledged once its
+row is durable.
+
+If a batch fails, its rows are retried one per transaction, so one bad row
+only fails its own caller. `on_insert(conn, rows)` runs inside each
+transaction after the inserts, for rows that must commit along with them.
+"""
+
+import threading
+import time
+
+
+class PendingInsert:
+    """One queued row and the outcome of the transaction that wrote it."""
+
+    def __init__(self, values):
+        self.values = values
+        self.row = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Coalesce concurrent inserts into `table` into shared transactions."""
+
+    def __init__(self, table, window=0.005, max_batch=100, on_insert=None):
+        self.table = table
+        self.window = window
+        self.max_batch = max_batch
+        self.on_insert = on_insert
+
+        self.lock = threading.Lock()
+        self.pending = []
+        self.leader_active = False
+
+    def submit(self, engine, values):
+        """Insert `values` and, once committed, return the inserted row as a
+        dict, including column defaults and the new primary key."""
+
+        item = PendingInsert(values)
+
+        with self.lock:
+            self.pending.append(item)
+            lead = not self.leader_active
+            self.leader_active = True
+
+        if lead:
+            self.lead(engine)
+
+        item.done.wait()
+        if item.error:
+            raise item.error
+        return item.row
+
+    def lead(self, engine):
+        """Gather the queued rows and commit them in batches of `max_batch`."""
+
+        time.sleep(self.window)
+
+        with self.lock:
+            queued, self.pending = self.pending, []
+            self.leader_active = False
+
+        for start in range(0, len(queued), self.max_batch):
+            self.commit(engine, queued[start:start + self.max_batch])
+
+    def insert(self, conn, values):
+        result = conn.execute(self.table.insert(), values)
+        row = dict(result.last_inserted_params())
+        row.update(zip([c.name for c in self.table.primary_key], result.inserted_primary_key))
+        return row
+
+    def fetch_server_defaults(self, conn, rows):
+        """Fill in columns the database set on insert, with one query."""
+
+        columns = [c for c in self.table.columns if c.server_default is not None]
+        pk = list(self.table.primary_key)
+        if not columns or not rows or len(pk) != 1:
+            return
+
+        by_key = {row[pk[0].name]: row for row in rows}
+        for values in conn.execute(self.table.select().where(pk[0].in_(list(by_key)))):
+            values = dict(zip([c.name for c in self.table.columns], values))
+            by_key[values[pk[0].name]].update((c.name, values[c.name]) for c in columns)
+
+    def commit(self, engine, batch):
+        try:
+            with engine.begin() as conn:
+                rows = [self.insert(conn, item.values) for item in batch]
+                self.fetch_server_defaults(conn, rows)
+                if self.on_insert:
+                    self.on_insert(conn, rows)
+        except Exception as exc:
+            if len(batch) > 1:
+                # find the bad rows without failing the good ones
+                for item in batch:
+                    self.commit(engine, [item])
+                return
+            batch[0].error = exc
+        else:
+            for item, row in zip(batch, rows):
+                item.row = row
+
+        for item in batch:
+            item.done.set()
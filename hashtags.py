@@ -0,0 +1,157 @@
+"""#tag and @mention extraction, with an inverted index of messages.
+
+Each term in a message gets a `message_terms` row keyed by
+(term, timestamp, message_id), so a tag feed or a "mentions of me" page is
+a range scan on that key instead of a LIKE over every message. Terms are
+stored lowercased, with their '#' or '@' prefix. Tags are word
+characters; mentions also take the '.' and '-' that usernames can
+contain, other than at the end, where they're punctuation.
+
+Index rows outlive a message's move to the archive (message_id has no
+foreign key to `messages`), so feeds include archived messages. Deleting
+a message removes its rows with `unindex_message`.
+"""
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from markupsafe import Markup
+
+from models import db, Message, ArchivedMessage, MessageTerm
+
+TERM_RE = re.compile(r'(?<![\w#@])(#\w+|@\w(?:[\w.-]*\w)?)')
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def extract_terms(text):
+    """Set of '#tag' and '@username' terms in `text`, lowercased."""
+
+    return {term.lower() for term in TERM_RE.findall(text)}
+
+
+def index_message(message):
+    """Add index rows for `message` (which must have an id) to the session."""
+
+    db.session.add_all(MessageTerm(term=term, timestamp=message.timestamp, message_id=message.id)
+                       for term in extract_terms(message.text))
+
+
+def index_rows(rows, conn=None):
+    """Add index rows for [(id, text, timestamp)] in one statement, on
+    `conn` if given, else the session."""
+
+    terms = tokenize_rows(rows)
+    if terms:
+        (conn or db.session).execute(MessageTerm.__table__.insert(), terms)
+
+
+def index_inserted(conn, rows):
+    """Index freshly inserted message rows (dicts) in the transaction that
+    inserted them; a GroupCommitter `on_insert` hook."""
+
+    index_rows([(row['id'], row['text'], row['timestamp']) for row in rows], conn)
+
+
+def unindex_message(message_id):
+    """Remove the index rows of a message being deleted. Doesn't commit."""
+
+    MessageTerm.query.filter(MessageTerm.message_id == message_id).delete(synchronize_session=False)
+
+
+def term_feed(term, limit=100):
+    """Newest `limit` messages containing `term`, live or archived."""
+
+    ids = [id for (id,) in (db.session
+                            .query(MessageTerm.message_id)
+                            .filter(MessageTerm.term == term.lower())
+                            .order_by(MessageTerm.timestamp.desc())
+                            .limit(limit))]
+    if not ids:
+        return []
+
+    found = {message.id: message for message in Message.query.filter(Message.id.in_(ids))}
+    missing = [id for id in ids if id not in found]
+    if missing:
+        found.update((message.id, message)
+                     for message in ArchivedMessage.query.filter(ArchivedMessage.id.in_(missing)))
+
+    return [found[id] for id in ids if id in found]
+
+
+def link_terms(text):
+    """HTML for `text` with tags linked to their feeds and mentions to a
+    user search."""
+
+    def link(match):
+        prefix, word = match.group()[0], match.group()[1:]
+        if prefix == '#':
+            return Markup('<a href="/tags/{}">#{}</a>').format(word.lower(), word)
+        return Markup('<a href="/users?q={}">@{}</a>').format(word, word)
+
+    # match the raw text: escaping first would turn quotes into &#39; and
+    # &#34;, which look like tags. Markup.join escapes the plain pieces.
+    pieces = []
+    last = 0
+    for match in TERM_RE.finditer(text):
+        pieces += [text[last:match.start()], link(match)]
+        last = match.end()
+    pieces.append(text[last:])
+
+    return Markup('').join(pieces)
+
+
+def tokenize_rows(rows):
+    """[(id, text, timestamp)] -> index rows as dicts (runs in a worker)."""
+
+    return [{'term': term, 'timestamp': timestamp, 'message_id': id}
+            for id, text, timestamp in rows
+            for term in extract_terms(text)]
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE, workers=None):
+    """Rebuild index rows for every message, live and archived.
+
+    Messages are read in id order a batch at a time and tokenized by a
+    pool of worker processes. Each batch's rows replace any existing rows
+    for its messages, so the job can be re-run safely. Returns the number
+    of messages indexed.
+    """
+
+    workers = workers or os.cpu_count()
+    indexed = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for model in (Message, ArchivedMessage):
+            indexed += backfill_table(model, batch_size, workers, pool)
+
+    return indexed
+
+
+def backfill_table(model, batch_size, workers, pool):
+    table = MessageTerm.__table__
+    last_id = 0
+    indexed = 0
+
+    while True:
+        rows = [tuple(row) for row in (db.session
+                .query(model.id, model.text, model.timestamp)
+                .filter(model.id > last_id)
+                .order_by(model.id)
+                .limit(batch_size))]
+        if not rows:
+            return indexed
+
+        chunk = max(1, len(rows) // (workers * 4))
+        chunks = [rows[i:i + chunk] for i in range(0, len(rows), chunk)]
+        terms = [term for chunk_terms in pool.map(tokenize_rows, chunks) for term in chunk_terms]
+
+        ids = [id for id, text, timestamp in rows]
+        db.session.execute(table.delete().where(table.c.message_id.in_(ids)))
+        if terms:
+            db.session.execute(table.insert(), terms)
+        db.session.commit()
+
+        last_id = ids[-1]
+        indexed += len(rows)
@@ -0,0 +1,150 @@
+"""Move existing messages to snowflake ids.
+
+Messages used to get serial ids, and a timestamp default that was
+evaluated once at import, so timelines ordered by timestamp came out in
+no useful order. New messages get time-sortable ids (snowflake.py) and a
+timestamp set by the database. `migrate` brings an existing database
+over:
+
+- on Postgres, message id columns (and every column referencing them)
+  become BIGINT, the serial default is dropped and the timestamp gets its
+  server-side default;
+- the (user_id, timestamp) index is replaced by (user_id, id);
+- every message with a serial id, live or archived, gets a snowflake id
+  made from its timestamp, in (timestamp, old id) order, so rows that
+  share a timestamp keep the order they were inserted in. Likes, index
+  terms, trending counts and notifications follow, and their old foreign
+  keys to messages.id are dropped (see archive.py).
+
+It runs in one transaction and only touches ids below snowflake.MIN_ID,
+so it can be re-run.
+
+Stop the app before running it on Postgres. Changing the column types
+takes an ACCESS EXCLUSIVE lock on every table involved, and running
+processes' prepared statements (prepared.py) would fail afterwards with
+"cached plan must not change result type". `migrate` refuses to start
+while other sessions are connected to the database, unless forced.
+"""
+
+from sqlalchemy import MetaData, Table, Column, BigInteger, DateTime, inspect, text
+
+from models import db, Message, ArchivedMessage, Likes, MessageTerm, TrendingCount, NotificationEvent
+from snowflake import IdGenerator, BACKFILL_WORKER_ID, MIN_ID, ms_of
+
+BATCH_SIZE = 5000
+
+# tables holding message ids, and the column they're in
+REFERENCES = [
+    (Likes.__table__, 'message_id'),
+    (MessageTerm.__table__, 'message_id'),
+    (TrendingCount.__table__, 'message_id'),
+    (NotificationEvent.__table__, 'message_id'),
+]
+
+id_map = Table('message_id_map', MetaData(),
+               Column('old_id', BigInteger, primary_key=True),
+               Column('new_id', BigInteger, nullable=False),
+               prefixes=['TEMPORARY'])
+
+
+class DatabaseInUse(Exception):
+    """Other sessions are connected to the database being migrated."""
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def other_sessions():
+    """Number of other client sessions on this database (Postgres)."""
+
+    return db.session.execute(text(
+        "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() "
+        "AND pid <> pg_backend_pid() AND backend_type = 'client backend'")).scalar()
+
+
+def alter_columns():
+    """Widen message id columns and move the defaults server-side (Postgres)."""
+
+    db.session.execute(text("ALTER TABLE messages ALTER COLUMN id TYPE BIGINT, ALTER COLUMN id DROP DEFAULT, "
+                            "ALTER COLUMN timestamp SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)"))
+    db.session.execute(text("DROP SEQUENCE IF EXISTS messages_id_seq"))
+    db.session.execute(text("ALTER TABLE messages_archive ALTER COLUMN id TYPE BIGINT"))
+    for table, column in REFERENCES:
+        db.session.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column} TYPE BIGINT"))
+
+
+def replace_index():
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_user_id_id ON messages (user_id, id)"))
+    db.session.execute(text("DROP INDEX IF EXISTS ix_messages_user_id_timestamp"))
+
+
+def message_foreign_keys():
+    """[(table, constraint name)] of foreign keys to messages.id (Postgres)."""
+
+    inspector = inspect(db.session.connection())
+    return [(table.name, fk['name'])
+            for table, column in REFERENCES
+            for fk in inspector.get_foreign_keys(table.name)
+            if fk['referred_table'] == 'messages' and fk['name']]
+
+
+def map_ids(batch_size):
+    """Fill the id map for every serial-id message; returns how many."""
+
+    generator = IdGenerator(worker_id=BACKFILL_WORKER_ID)
+    query = (text("SELECT id, timestamp FROM messages WHERE id < :min_id "
+                  "UNION ALL SELECT id, timestamp FROM messages_archive WHERE id < :min_id "
+                  "ORDER BY 2, 1")
+             .columns(id=BigInteger, timestamp=DateTime)
+             .execution_options(stream_results=True))
+    result = db.session.execute(query, {'min_id': MIN_ID})
+
+    mapped = 0
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return mapped
+        db.session.execute(id_map.insert(), [{'old_id': old_id, 'new_id': generator.next_id_at(ms_of(timestamp))}
+                                             for old_id, timestamp in rows])
+        mapped += len(rows)
+
+
+def remap(table, column):
+    db.session.execute(text(
+        f"UPDATE {table} SET {column} = (SELECT new_id FROM message_id_map WHERE old_id = {table}.{column}) "
+        f"WHERE {column} IN (SELECT old_id FROM message_id_map)"))
+
+
+def migrate(batch_size=BATCH_SIZE, force=False):
+    """Migrate the schema and give existing messages snowflake ids;
+    returns the number of messages given new ids. Raises DatabaseInUse if
+    other sessions are connected, unless `force`."""
+
+    postgres = is_postgres()
+    if postgres:
+        sessions = other_sessions()
+        if sessions and not force:
+            db.session.rollback()
+            raise DatabaseInUse(f"{sessions} other sessions are connected; stop the app first.")
+        alter_columns()
+    replace_index()
+
+    id_map.create(db.session.connection())
+    migrated = map_ids(batch_size)
+
+    # references may point at either tier, so they no longer have foreign
+    # keys; dropping them also lets rows be updated in place (new ids never
+    # collide with old ones)
+    for table, name in message_foreign_keys() if postgres else []:
+        db.session.execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {name}"))
+
+    if migrated:
+        remap(Message.__tablename__, 'id')
+        remap(ArchivedMessage.__tablename__, 'id')
+        for table, column in REFERENCES:
+            remap(table.name, column)
+
+    id_map.drop(db.session.connection())
+    db.session.commit()
+    return migrated
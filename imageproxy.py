@@ -0,0 +1,441 @@
+"""Resized, locally cached copies of user avatars and header images.
+
+`User.image_url` and `header_image_url` can point anywhere, so rather than
+have every browser fetch every original at full size, templates link to
+`/images/<size>/<signature>?u=<source>` through the `thumbnail` filter.
+The first request for a source fetches it once, stores the original under
+its content hash and writes a resized copy per size next to it; later
+requests (for any size, and for any other URL with the same content) are
+served from disk. Files are evicted least recently used first once the
+cache outgrows `max_bytes`. Every worker process shares the directory, so
+the running total lives in a file next to the cache, updated under a file
+lock, and eviction goes by file access times rather than anything one
+process remembers.
+
+URLs are signed with the app's secret key, so the proxy only fetches
+sources the app itself linked to, and by default it refuses sources on
+private or loopback addresses. Each host is resolved once and the
+connection is made to the address that was checked, so a DNS answer that
+changes in between (DNS rebinding) can't point the fetch elsewhere.
+
+Resizing needs the optional Pillow package; without it the original is
+cached and served as is. Either way only the raster types in IMAGE_TYPES
+are accepted: an SVG served from our own origin could run script. Images
+over MAX_PIXELS are refused from their header, before Pillow decodes
+them, since a small compressed file can expand to gigabytes.
+"""
+
+import fcntl
+import functools
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import mimetypes
+import os
+import shutil
+import socket
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import warnings
+from contextlib import contextmanager
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+URL_PREFIX = '/images/'
+
+# name: (width, height, crop to exactly that size), at twice the CSS size
+# so they stay sharp on high-density screens
+SIZES = {
+    'small': (96, 96, True),        # timeline and navbar avatars
+    'card': (140, 140, True),       # user card avatars
+    'profile': (400, 400, True),    # profile page avatar
+    'header': (1280, 720, False),   # header images, fitted within the box
+}
+
+JPEG_QUALITY = 85
+
+# largest source image decoded, in pixels (e.g. 8000 x 5000)
+MAX_PIXELS = 40 * 1000 * 1000
+
+# eviction removes files until the cache is down to this share of max_bytes,
+# so it doesn't have to rescan the directory on every store
+EVICT_TO = 0.9
+
+# types fetched and served; no SVG or anything else that can carry script
+IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+
+
+class ImageFetchError(Exception):
+    """The source couldn't be fetched, or isn't an image."""
+
+
+def signature(secret, size, source):
+    message = f"{size}\n{source}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:16]
+
+
+def proxy_url(source, size, secret):
+    """Proxied URL of `source` resized to `size`."""
+
+    query = urllib.parse.urlencode({'u': source})
+    return f"{URL_PREFIX}{size}/{signature(secret, size, source)}?{query}"
+
+
+def verify(secret, size, source, sig):
+    return size in SIZES and hmac.compare_digest(signature(secret, size, source), sig)
+
+
+def resolve(host, allow_private=False):
+    """The address to connect to for `host`. Unless `allow_private`, every
+    address `host` resolves to must be a public one."""
+
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError):
+        addresses = []
+
+    if not addresses:
+        raise ImageFetchError(f"can't resolve {host}")
+    if not allow_private and not all(ipaddress.ip_address(address.split('%')[0]).is_global
+                                     for address in addresses):
+        raise ImageFetchError(f"{host} isn't a public host")
+    return addresses[0]
+
+
+def resize(content, size, max_pixels=MAX_PIXELS):
+    """(bytes, mimetype) of `content` resized to the named size.
+
+    Images with transparency come back as PNG, everything else as JPEG.
+    Images over `max_pixels` are refused before they're decoded.
+    """
+
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return content, None
+
+    width, height, crop = SIZES[size]
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+            # only reads the header
+            image = Image.open(io.BytesIO(content))
+            if image.width * image.height > max_pixels:
+                raise ImageFetchError(f"image is {image.width}x{image.height}, over {max_pixels} pixels")
+
+            image = ImageOps.exif_transpose(image)
+            if crop:
+                image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            else:
+                image.thumbnail((width, height), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError, Image.DecompressionBombWarning) as exc:
+        raise ImageFetchError(f"not a usable image: {exc}")
+
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'image/png'
+
+    image.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+class ImageCache:
+    """Disk cache of fetched images and their resized copies.
+
+    Under `directory`, sources/ maps a hash of each source URL to the hash
+    of its content, and files/ holds the original (`<hash>`) and resized
+    copies (`<hash>.<size><ext>`). Only files/ counts towards `max_bytes`;
+    `usage` holds its total size and `lock` guards updates to it.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, allow_private=False,
+                 timeout=5, max_source_bytes=10 * 1024 * 1024, static_dir=STATIC_DIR):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.allow_private = allow_private
+        self.timeout = timeout
+        self.max_source_bytes = max_source_bytes
+        self.static_dir = static_dir
+
+        self.fetches = 0
+
+    def get(self, source, size):
+        """(path, mimetype, etag) of `source` resized to `size`, fetching
+        and resizing it first if need be."""
+
+        content_hash, mimetype = self.lookup(source)
+        if content_hash:
+            found = self.find(content_hash, size)
+            if found:
+                return found
+
+        content = self.read(self.path(content_hash)) if content_hash else None
+        if content is None:
+            content, mimetype = self.fetch(source)
+            content_hash = hashlib.sha256(content).hexdigest()[:32]
+            self.store(self.path(content_hash), content)
+            self.record(source, content_hash, mimetype)
+
+        resized, resized_type = resize(content, size)
+        mimetype = resized_type or mimetype
+        path = f"{self.path(content_hash)}.{size}{mimetypes.guess_extension(mimetype) or '.bin'}"
+        self.store(path, resized)
+        return path, mimetype, f"{content_hash}.{size}"
+
+    def find(self, content_hash, size):
+        """The cached copy of `content_hash` at `size`, if there is one."""
+
+        prefix = f"{content_hash}.{size}"
+        directory = os.path.dirname(self.path(content_hash))
+        try:
+            names = [name for name in os.listdir(directory) if name.startswith(prefix + '.')]
+        except FileNotFoundError:
+            return None
+        if not names:
+            return None
+
+        path = os.path.join(directory, names[0])
+        mimetype = mimetypes.guess_type(path)[0]
+        if mimetype not in IMAGE_TYPES:
+            return None
+        self.touch(path)
+        return path, mimetype, prefix
+
+    def path(self, content_hash):
+        return os.path.join(self.directory, 'files', content_hash[:2], content_hash)
+
+    def source_path(self, source):
+        key = hashlib.sha256(source.encode()).hexdigest()
+        return os.path.join(self.directory, 'sources', key[:2], key)
+
+    def lookup(self, source):
+        """(content hash, mimetype) of `source` if it's been fetched before."""
+
+        try:
+            with open(self.source_path(source)) as file:
+                content_hash, mimetype = file.read().split()
+        except (FileNotFoundError, ValueError):
+            return None, None
+        return content_hash, mimetype
+
+    def record(self, source, content_hash, mimetype):
+        path = self.source_path(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(f"{content_hash} {mimetype}\n")
+
+    def read(self, path):
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        self.touch(path)
+        return content
+
+    def fetch(self, source):
+        """(content, mimetype) of the image at `source`: a /static/ path
+        or an http(s) URL."""
+
+        if source.startswith('/static/'):
+            return self.fetch_static(source[len('/static/'):])
+
+        parts = urllib.parse.urlsplit(source)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageFetchError(f"can't fetch {source!r}")
+
+        opener = urllib.request.build_opener(CheckedRedirectHandler(),
+                                             PinnedHTTPHandler(self), PinnedHTTPSHandler(self))
+        request = urllib.request.Request(source, headers={'User-Agent': 'warbler-image-proxy'})
+
+        try:
+            with opener.open(request, timeout=self.timeout) as response:
+                mimetype = response.headers.get_content_type()
+                if mimetype not in IMAGE_TYPES:
+                    raise ImageFetchError(f"{source} is {mimetype}, not a supported image")
+                content = response.read(self.max_source_bytes + 1)
+        except (urllib.error.URLError, OSError, ValueError) as exc:
+            raise ImageFetchError(f"fetching {source} failed: {exc}")
+
+        if len(content) > self.max_source_bytes:
+            raise ImageFetchError(f"{source} is over {self.max_source_bytes} bytes")
+
+        self.fetches += 1
+        return content, mimetype
+
+    def fetch_static(self, relative):
+        path = os.path.normpath(os.path.join(self.static_dir, relative))
+        mimetype = mimetypes.guess_type(path)[0] or ''
+        if not path.startswith(self.static_dir + os.sep) or mimetype not in IMAGE_TYPES:
+            raise ImageFetchError(f"no static image {relative!r}")
+
+        try:
+            with open(path, 'rb') as file:
+                return file.read(), mimetype
+        except OSError as exc:
+            raise ImageFetchError(f"reading {relative} failed: {exc}")
+
+    def check_host(self, host):
+        """The checked address to connect to for `host`."""
+
+        return resolve(host, self.allow_private)
+
+    def scan(self):
+        """[(path, size)] of the cached files, least recently used first."""
+
+        found = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.directory, 'files')):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        return [(path, size) for mtime, path, size in sorted(found)]
+
+    def touch(self, path):
+        """Mark `path` as just used; eviction goes by mtime."""
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def locked(self):
+        """Hold the cache's file lock, shared by every process using it."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def usage(self):
+        """Total size of files/ (lock held), counted afresh if unknown."""
+
+        try:
+            with open(os.path.join(self.directory, 'usage')) as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return sum(size for path, size in self.scan())
+
+    def set_usage(self, total):
+        with open(os.path.join(self.directory, 'usage'), 'w') as file:
+            file.write(str(total))
+
+    def store(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, 'wb') as file:
+            file.write(content)
+
+        with self.locked():
+            total = self.usage()
+            try:
+                total -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(temp, path)
+            total += len(content)
+            if total > self.max_bytes:
+                total = self.evict(keep=path)
+            self.set_usage(total)
+
+    def evict(self, keep):
+        """Remove least recently used files, other than `keep`, until the
+        cache is down to EVICT_TO of `max_bytes` (lock held). Returns the
+        new total, counted from disk."""
+
+        files = self.scan()
+        total = sum(size for path, size in files)
+
+        for path, size in files:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        return total
+
+    def clear(self):
+        with self.locked():
+            shutil.rmtree(os.path.join(self.directory, 'files'), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.directory, 'sources'), ignore_errors=True)
+            try:
+                os.remove(os.path.join(self.directory, 'usage'))
+            except FileNotFoundError:
+                pass
+
+
+class CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects only to http(s) URLs; their hosts are checked
+    when connecting, like any other."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        parts = urllib.parse.urlsplit(newurl)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageFetchError(f"redirected to {newurl!r}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class PinnedConnection:
+    """Connects to the address `cache.check_host` approved for the host
+    instead of resolving it again. TLS still verifies the host name."""
+
+    def __init__(self, *args, cache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    def connect(self):
+        address = self.cache.check_host(self.host)
+
+        def create_connection(host_port, *args):
+            return socket.create_connection((address, host_port[1]), *args)
+
+        self._create_connection = create_connection
+        super().connect()
+
+
+class PinnedHTTPConnection(PinnedConnection, http.client.HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(PinnedConnection, http.client.HTTPSConnection):
+    pass
+
+
+class PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(PinnedHTTPConnection, cache=self.cache), req)
+
+
+class PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(PinnedHTTPSConnection, cache=self.cache), req,
+                            context=self._context)
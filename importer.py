@@ -0,0 +1,149 @@
+"""Bulk import of messages from other platforms.
+
+Input is NDJSON, one message per line:
+
+    {"text": "hello", "timestamp": "2017-01-21T11:04:53"}
+
+Lines are validated a batch at a time and each valid batch is written
+with one multi-row INSERT in its own transaction, along with the messages'
+#tag and @mention index rows. Messages keep their original timestamps,
+which must lie between snowflake.MIN_TIMESTAMP and now, and get ids made
+from them (snowflake.backdated_ids), so they sort into timelines where
+they were posted. A batch whose ids collide with existing ones is
+retried with fresh ids.
+"""
+
+import json
+from datetime import datetime, timezone
+
+from dateutil.parser import isoparse
+from sqlalchemy.exc import IntegrityError
+
+import hashtags
+from models import db, Message
+from snowflake import MIN_TIMESTAMP, backdated_ids, ms_of
+
+BATCH_SIZE = 1000
+MAX_ERRORS = 100
+MAX_TEXT_LENGTH = Message.__table__.c.text.type.length
+# attempts at a batch whose ids collide with existing messages
+ID_ATTEMPTS = 3
+
+
+def parse_lines(lines):
+    """Yield (line number, record) for each non-blank line; the record is
+    None where the line isn't a JSON object (or isn't valid UTF-8)."""
+
+    for line_no, line in enumerate(lines, start=1):
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield line_no, None
+            continue
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+
+        yield line_no, record if isinstance(record, dict) else None
+
+
+def parse_timestamp(value):
+    """ISO 8601 string to naive UTC datetime (now, if missing)."""
+
+    if value is None:
+        return datetime.utcnow()
+
+    timestamp = isoparse(value)
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def validate_batch(batch, user_id):
+    """Split a batch of (line number, record) into insertable rows and
+    (line number, reason) errors."""
+
+    records = [(line_no, record) for line_no, record in batch if record is not None]
+    errors = [(line_no, "not a JSON object") for line_no, record in batch if record is None]
+
+    texts = [record.get('text') for line_no, record in records]
+    text_ok = [isinstance(text, str) and 0 < len(text) <= MAX_TEXT_LENGTH for text in texts]
+
+    rows = []
+    for (line_no, record), text, ok in zip(records, texts, text_ok):
+        if not ok:
+            errors.append((line_no, f"text must be 1-{MAX_TEXT_LENGTH} characters"))
+            continue
+
+        try:
+            timestamp = parse_timestamp(record.get('timestamp'))
+        except (TypeError, ValueError, OverflowError):
+            errors.append((line_no, "invalid timestamp"))
+            continue
+
+        if not MIN_TIMESTAMP <= timestamp <= datetime.utcnow():
+            errors.append((line_no, f"timestamp must be between {MIN_TIMESTAMP:%Y-%m-%d} and now"))
+            continue
+
+        rows.append({'text': text, 'timestamp': timestamp, 'user_id': user_id})
+
+    return rows, sorted(errors)
+
+
+def insert_batch(rows):
+    if not rows:
+        return
+
+    for attempt in range(ID_ATTEMPTS):
+        ids = backdated_ids(ms_of(row['timestamp']) for row in rows)
+        rows = [dict(row, id=id) for row, id in zip(rows, ids)]
+        try:
+            db.session.execute(Message.__table__.insert().values(rows))
+            hashtags.index_rows([(row['id'], row['text'], row['timestamp']) for row in rows])
+            db.session.commit()
+            return
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == ID_ATTEMPTS - 1:
+                raise
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_messages(user_id, lines, batch_size=BATCH_SIZE):
+    """Import NDJSON `lines` as messages by `user_id`.
+
+    Returns a summary dict with the number imported and rejected, and the
+    first MAX_ERRORS rejected line numbers with reasons.
+    """
+
+    imported = rejected = 0
+    errors = []
+
+    for batch in batches(parse_lines(lines), batch_size):
+        rows, batch_errors = validate_batch(batch, user_id)
+        insert_batch(rows)
+
+        imported += len(rows)
+        rejected += len(batch_errors)
+        errors.extend(batch_errors[:MAX_ERRORS - len(errors)])
+
+    return {
+        'imported': imported,
+        'rejected': rejected,
+        'errors': [{'line': line_no, 'reason': reason} for line_no, reason in errors],
+    }
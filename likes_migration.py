@@ -0,0 +1,47 @@
+"""Allow a message to be liked by more than one user.
+
+The likes table used to be unique on message_id alone, so only one user
+could like each message. `migrate` brings an existing database over:
+
+- on Postgres, unique constraints on message_id alone are dropped and
+  (user_id, message_id) becomes unique instead;
+- message_id gets a plain index, for counting and deleting a message's
+  likes.
+
+No existing rows break the new constraint (each message had at most one
+like), and each step checks whether it's already done, so it can be
+re-run. Tables created by db.create_all() from the current models already
+have this schema.
+"""
+
+from sqlalchemy import inspect, text
+
+from models import db
+
+NEW_UNIQUE = ['user_id', 'message_id']
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def migrate():
+    """Update the likes constraints and index; returns the names of the
+    dropped constraints."""
+
+    dropped = []
+
+    if is_postgres():
+        constraints = inspect(db.session.connection()).get_unique_constraints('likes')
+        for constraint in constraints:
+            if constraint['column_names'] == ['message_id']:
+                db.session.execute(text(f'ALTER TABLE likes DROP CONSTRAINT "{constraint["name"]}"'))
+                dropped.append(constraint['name'])
+
+        if not any(sorted(c['column_names']) == sorted(NEW_UNIQUE) for c in constraints):
+            db.session.execute(text("ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key "
+                                    "UNIQUE (user_id, message_id)"))
+
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id)"))
+    db.session.commit()
+    return dropped
@@ -0,0 +1,74 @@
+"""Request-scoped batch loading of many-to-one relationships.
+
+Rendering a list of messages touches `msg.user` for every row, which
+lazy-loads each distinct author with its own query. A view can instead
+hand the list to the request's BatchLoader:
+
+    batch_loader().prime(messages, 'user')
+
+which collects the author ids, loads them with one IN query per model,
+and fills in `msg.user` so the template never triggers a lazy load.
+"""
+
+from collections import defaultdict
+
+from flask import g
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+class BatchLoader:
+    """Collect ids per model, then resolve each model with one IN query."""
+
+    def __init__(self):
+        self.pending = defaultdict(set)
+        self.loaded = defaultdict(dict)
+
+    def want(self, model, ids):
+        """Ask for these ids of `model` to be loaded at the next resolve()."""
+
+        self.pending[model].update(id for id in ids if id not in self.loaded[model])
+
+    def resolve(self):
+        for model, ids in self.pending.items():
+            if ids:
+                pk = inspect(model).primary_key[0]
+                for instance in model.query.filter(pk.in_(ids)):
+                    self.loaded[model][getattr(instance, pk.key)] = instance
+        self.pending.clear()
+
+    def get(self, model, id):
+        return self.loaded[model].get(id)
+
+    def prime(self, objects, attr):
+        """Load and set the many-to-one relationship `attr` on every object
+        in `objects`, which may mix mapped classes (e.g. live and archived
+        messages)."""
+
+        by_class = defaultdict(list)
+        for obj in objects:
+            by_class[type(obj)].append(obj)
+
+        targets = []
+        for cls, instances in by_class.items():
+            prop = inspect(cls).relationships[attr]
+            column = next(iter(prop.local_columns))
+            model = prop.mapper.class_
+            self.want(model, (getattr(obj, column.key) for obj in instances))
+            targets.append((instances, column, model))
+
+        self.resolve()
+
+        for instances, column, model in targets:
+            for obj in instances:
+                set_committed_value(obj, attr, self.get(model, getattr(obj, column.key)))
+
+        return objects
+
+
+def batch_loader():
+    """This request's BatchLoader."""
+
+    if 'batch_loader' not in g:
+        g.batch_loader = BatchLoader()
+    return g.batch_loader
@@ -4,11 +4,37 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from snowflake import next_message_id
 
 bcrypt = Bcrypt()
 db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 
+class utcnow(FunctionElement):
+    """The database's current time in UTC, for server-side defaults."""
+
+    type = db.DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def compile_utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def compile_utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow, 'sqlite')
+def compile_utcnow_sqlite(element, compiler, **kw):
+    return "(STRFTIME('%Y-%m-%d %H:%M:%f', 'now'))"
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -27,10 +53,23 @@ class Follows(db.Model):
     )
 
 
+def follow_exists(follower_id, followed_id):
+    query = Follows.query.filter_by(user_following_id=follower_id, user_being_followed_id=followed_id)
+    return db.session.query(query.exists()).scalar()
+
+
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
 
-    __tablename__ = 'likes' 
+    `message_id` may be a live or an archived message, so it has no
+    foreign key; deleting a message removes its likes explicitly (see
+    archive.forget_messages).
+    """
+
+    __tablename__ = 'likes'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -43,9 +82,8 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
-        db.ForeignKey('messages.id', ondelete='CASCADE'),
-        unique=True
+        db.BigInteger,
+        index=True,
     )
 
 
@@ -110,9 +148,12 @@ class User(db.Model):
         secondaryjoin=(Follows.user_being_followed_id == id)
     )
 
+    # liked messages still in the hot table; see archive.liked_messages
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="User.id == Likes.user_id",
+        secondaryjoin="foreign(Likes.message_id) == Message.id",
     )
 
     def __repr__(self):
@@ -121,14 +162,20 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if 'followers' in self.__dict__:
+            return other_user in self.followers
+        return follow_exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        Uses the following collection if it's already loaded, otherwise
+        looks up the one follows row rather than loading the collection.
+        """
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if 'following' in self.__dict__:
+            return other_user in self.following
+        return follow_exists(self.id, other_user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -171,13 +218,27 @@ class User(db.Model):
 
 
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are time-sortable (see snowflake.py), so timelines order and
+    paginate by id. The timestamp is set by the database on insert.
+    """
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp'),
+    )
+    # fetch the server-set timestamp on insert
+    __mapper_args__ = {'eager_defaults': True}
+
+    archived = False
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_message_id,
     )
 
     text = db.Column(
@@ -188,7 +249,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -200,6 +261,172 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` by the archive job.
+
+    On Postgres the table is partitioned by month of `timestamp`; see
+    archive.py for partition maintenance.
+    """
+
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_timestamp', 'user_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+    archived = True
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user = db.relationship('User')
+
+
+class MessageTerm(db.Model):
+    """Inverted index entry: a #tag or @mention used in a message.
+
+    `message_id` may be a live or an archived message, so it has no
+    foreign key.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+
+class TrendingCount(db.Model):
+    """Snapshot of likes a message received in one trending time bucket.
+
+    Like `Likes.message_id`, `message_id` has no foreign key so counts
+    survive archiving.
+    """
+
+    __tablename__ = 'trending_counts'
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class NotificationEvent(db.Model):
+    """Something that happened to a user: a like of one of their messages
+    or a new follower. Rows are only ever appended, and deleted when
+    compaction replaces old ones with aggregates (kind 'likes' or
+    'follows', `count` events, `actor_id` the latest actor).
+
+    `message_id` has no foreign key so events survive archiving;
+    `message` only finds messages still in the hot table."""
+
+    __tablename__ = 'notification_events'
+    __table_args__ = (
+        db.Index('ix_notification_events_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+    message = db.relationship('Message', primaryjoin="foreign(NotificationEvent.message_id) == Message.id",
+                              viewonly=True)
+
+
+class NotificationCounter(db.Model):
+    """Number of notification events a user hasn't seen yet."""
+
+    __tablename__ = 'notification_counters'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,146 @@
+"""Like and follow notifications.
+
+Each like of someone's message and each new follower appends one row to
+`notification_events`, and bumps the recipient's row in
+`notification_counters` in the same transaction, so the unread badge in
+the navbar is a single primary-key lookup rather than a count. Liking
+again after an unlike, or following again after an unfollow, doesn't add
+a second event for the same actor and message.
+
+Events are never updated. `compact` keeps the table from growing without
+bound: events older than a cutoff are collapsed into one aggregate per
+message ("12 people liked your warble") and one per user for follows.
+The unread counter counts events, so compaction doesn't change it.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, func
+
+from models import db, NotificationEvent, NotificationCounter
+
+LIKE = 'like'
+FOLLOW = 'follow'
+# aggregates written by compaction
+LIKES = 'likes'
+FOLLOWS = 'follows'
+
+COMPACT_AFTER_DAYS = 7
+BATCH_SIZE = 1000
+
+events = NotificationEvent.__table__
+counters = NotificationCounter.__table__
+
+
+def is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def increment_unread(user_id, by=1):
+    if is_postgres():
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        stmt = pg_insert(counters).values(user_id=user_id, unread=by)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[counters.c.user_id],
+            set_={'unread': counters.c.unread + stmt.excluded.unread}))
+        return
+
+    updated = db.session.execute(
+        counters.update().where(counters.c.user_id == user_id).values(unread=counters.c.unread + by)).rowcount
+    if not updated:
+        db.session.execute(counters.insert().values(user_id=user_id, unread=by))
+
+
+def notify(user_id, kind, actor_id, message_id=None):
+    """Append an event for `user_id` and count it as unread. Nothing is
+    recorded for users acting on themselves, or if `user_id` already has
+    this event (same kind, actor and message) not yet compacted. Doesn't
+    commit."""
+
+    if user_id == actor_id:
+        return
+
+    same_message = events.c.message_id.is_(None) if message_id is None else events.c.message_id == message_id
+    seen = db.session.query(events.c.id).filter(events.c.user_id == user_id, events.c.kind == kind,
+                                                 events.c.actor_id == actor_id, same_message)
+    if db.session.query(seen.exists()).scalar():
+        return
+
+    db.session.execute(events.insert().values(user_id=user_id, kind=kind, actor_id=actor_id,
+                                              message_id=message_id, count=1,
+                                              created_at=datetime.utcnow()))
+    increment_unread(user_id)
+
+
+def unread_count(user_id):
+    return db.session.query(counters.c.unread).filter(counters.c.user_id == user_id).scalar() or 0
+
+
+def mark_read(user_id):
+    """Reset the user's unread count. Doesn't commit."""
+
+    db.session.execute(counters.update().where(counters.c.user_id == user_id).values(unread=0))
+
+
+def recent(user_id, limit=50):
+    """The user's newest events, aggregates included."""
+
+    return (NotificationEvent
+            .query
+            .filter(NotificationEvent.user_id == user_id)
+            .order_by(NotificationEvent.created_at.desc(), NotificationEvent.id.desc())
+            .limit(limit)
+            .all())
+
+
+def compact_groups(kinds, aggregate_kind, group_columns, cutoff, batch_size):
+    """Replace each group of two or more events of `kinds` older than
+    `cutoff` with one `aggregate_kind` event; returns events removed."""
+
+    old = and_(events.c.kind.in_(kinds), events.c.created_at < cutoff)
+    groups = (db.session.query(*group_columns, func.sum(events.c.count), func.max(events.c.created_at),
+                               func.max(events.c.id), func.count())
+              .filter(old)
+              .group_by(*group_columns)
+              .having(func.count() > 1)
+              .all())
+
+    delete = events.delete().where(and_(
+        old,
+        events.c.id <= bindparam('last_id'),
+        *[column == bindparam(f"group_{column.key}") for column in group_columns]))
+
+    removed = 0
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        last_ids = [group[-2] for group in batch]
+        actors = dict(db.session.query(events.c.id, events.c.actor_id).filter(events.c.id.in_(last_ids)))
+
+        aggregates = []
+        deletes = []
+        for *keys, total, created_at, last_id, n in batch:
+            row = dict(zip([column.key for column in group_columns], keys))
+            aggregates.append({'user_id': row['user_id'], 'message_id': row.get('message_id'),
+                               'kind': aggregate_kind, 'actor_id': actors.get(last_id),
+                               'count': total, 'created_at': created_at})
+            deletes.append({'last_id': last_id, **{f"group_{key}": value for key, value in row.items()}})
+            removed += n
+
+        db.session.execute(delete, deletes)
+        db.session.execute(events.insert(), aggregates)
+        db.session.commit()
+
+    return removed
+
+
+def compact(older_than=timedelta(days=COMPACT_AFTER_DAYS), batch_size=BATCH_SIZE, now=None):
+    """Collapse events older than `older_than` into aggregates; returns
+    {'likes': events removed, 'follows': events removed}."""
+
+    cutoff = (now or datetime.utcnow()) - older_than
+
+    return {
+        'likes': compact_groups([LIKE, LIKES], LIKES, [events.c.user_id, events.c.message_id], cutoff, batch_size),
+        'follows': compact_groups([FOLLOW, FOLLOWS], FOLLOWS, [events.c.user_id], cutoff, batch_size),
+    }
@@ -0,0 +1,146 @@
+"""Server-side prepared statements for the hottest queries.
+
+Each HotQuery has a name, the SQL to PREPARE on Postgres, and an ORM
+fallback that is used on other databases or when prepared statements
+are switched off. A statement is prepared the first time it runs on a
+pooled connection and is reused on that connection after that, so
+Postgres parses and plans it once per connection rather than on every
+request.
+
+Server-side statements live on the connection, so this doesn't work
+behind a pooler that hands out a different server connection per
+transaction, such as PgBouncer in transaction mode.
+"""
+
+import time
+
+from sqlalchemy import text
+
+from models import db, User, Message, Likes, Follows
+
+
+class HotQuery:
+    """A named query with positional parameters."""
+
+    def __init__(self, name, model, param_types, sql, fallback, one=False):
+        self.name = name
+        self.model = model
+        self.param_types = param_types
+        self.sql = sql
+        self.fallback = fallback
+        self.one = one
+
+    def prepare(self, conn):
+        """PREPARE this statement on `conn` unless it already has been."""
+
+        prepared = conn.info.setdefault('prepared_statements', set())
+        if self.name not in prepared:
+            conn.execute(text(f"PREPARE {self.name} ({', '.join(self.param_types)}) AS {self.sql}"))
+            prepared.add(self.name)
+
+    def execute(self, *params):
+        conn = db.session.connection()
+        self.prepare(conn)
+
+        binds = ', '.join(f":p{i}" for i in range(len(params)))
+        query = (db.session
+                 .query(self.model)
+                 .from_statement(text(f"EXECUTE {self.name} ({binds})"))
+                 .params({f"p{i}": param for i, param in enumerate(params)}))
+
+        return query.one_or_none() if self.one else query.all()
+
+
+class HotQueryRegistry:
+    """Named hot queries, run prepared or through the ORM."""
+
+    def __init__(self):
+        self.queries = {}
+        self.enabled = False
+
+    def register(self, *args, **kwargs):
+        query = HotQuery(*args, **kwargs)
+        self.queries[query.name] = query
+
+    def statement(self, name):
+        """(param_types, sql) of the query PREPAREd as `name`, or None."""
+
+        query = self.queries.get(name)
+        return (query.param_types, query.sql) if query else None
+
+    def use_prepared(self):
+        return self.enabled and db.session.get_bind().dialect.name == 'postgresql'
+
+    def run(self, name, *params):
+        query = self.queries[name]
+        if self.use_prepared():
+            return query.execute(*params)
+        return query.fallback(*params)
+
+    def benchmark(self, name, params, iterations=1000):
+        """Average seconds per call of `name`, prepared and unprepared."""
+
+        results = {}
+
+        for label, enabled in (('unprepared', False), ('prepared', True)):
+            self.enabled = enabled
+            self.run(name, *params)
+            db.session.expunge_all()
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                self.run(name, *params)
+                db.session.expunge_all()
+            results[label] = (time.perf_counter() - start) / iterations
+
+        return results
+
+
+hot_queries = HotQueryRegistry()
+
+USER_COLUMNS = "id, email, username, image_url, header_image_url, bio, location, password"
+MESSAGE_COLUMNS = "messages.id, messages.text, messages.timestamp, messages.user_id"
+
+hot_queries.register(
+    'user_by_id', User, ['int'],
+    f"SELECT {USER_COLUMNS} FROM users WHERE id = $1",
+    lambda user_id: User.query.get(user_id),
+    one=True,
+)
+
+hot_queries.register(
+    'home_timeline', Message, ['int', 'int'],
+    f"SELECT {MESSAGE_COLUMNS} FROM messages "
+    f"JOIN follows ON follows.user_being_followed_id = messages.user_id "
+    f"WHERE follows.user_following_id = $1 "
+    f"ORDER BY messages.id DESC LIMIT $2",
+    lambda user_id, limit: (Message
+                            .query
+                            .join(Follows, Follows.user_being_followed_id == Message.user_id)
+                            .filter(Follows.user_following_id == user_id)
+                            .order_by(Message.id.desc())
+                            .limit(limit)
+                            .all()),
+)
+
+hot_queries.register(
+    'user_messages', Message, ['int', 'int'],
+    f"SELECT {MESSAGE_COLUMNS} FROM messages "
+    f"WHERE user_id = $1 ORDER BY id DESC LIMIT $2",
+    lambda user_id, limit: (Message
+                            .query
+                            .filter(Message.user_id == user_id)
+                            .order_by(Message.id.desc())
+                            .limit(limit)
+                            .all()),
+)
+
+hot_queries.register(
+    'user_like', Likes, ['int', 'bigint'],
+    "SELECT id, user_id, message_id FROM likes WHERE user_id = $1 AND message_id = $2",
+    lambda user_id, message_id: (Likes
+                                 .query
+                                 .filter(Likes.user_id == user_id, Likes.message_id == message_id)
+                                 .one_or_none()),
+    one=True,
+)
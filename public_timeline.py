@@ -0,0 +1,131 @@
+"""Shared "latest warbles" timeline for logged-out visitors.
+
+Anonymous visitors all see the same feed, so rather than query it for
+each of them, one snapshot is kept in a shared store (Redis, or an
+in-process stand-in): the latest messages as plain rows, and the HTML
+rendered from them. Once a snapshot is older than `ttl` seconds, the
+first request to notice takes a lock in the store and rebuilds it, while
+every other request, in any process, keeps being served the previous
+snapshot. Only a cold start, with no snapshot at all, waits for the
+rebuild, and only for up to `wait` seconds. A rebuild that fails (say,
+the database is down) is logged and the previous snapshot served.
+"""
+
+import logging
+import pickle
+import time
+import uuid
+
+from flask import render_template
+
+from cache import LocalStore
+from models import db, User, Message
+
+LIMIT = 50
+
+logger = logging.getLogger(__name__)
+
+
+def make_store(redis_url=None):
+    """Redis at `redis_url` if given, else a store local to this process."""
+
+    if redis_url:
+        import redis
+        return redis.Redis.from_url(redis_url)
+    return LocalStore()
+
+
+def latest_messages(limit=LIMIT):
+    """The newest messages with their authors, as plain dicts."""
+
+    rows = (db.session.query(Message.id, Message.text, Message.timestamp,
+                             User.id, User.username, User.image_url)
+            .join(User, User.id == Message.user_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+            .all())
+
+    return [{'id': message_id, 'text': text, 'timestamp': timestamp,
+             'user': {'id': user_id, 'username': username, 'image_url': image_url}}
+            for message_id, text, timestamp, user_id, username, image_url in rows]
+
+
+class PublicTimeline:
+    """A periodically rebuilt, shared snapshot of the public timeline."""
+
+    def __init__(self, store, ttl=30, lock_timeout=30, wait=5, limit=LIMIT,
+                 prefix='warbler:public-timeline', clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait = wait
+        self.limit = limit
+        self.key = f"{prefix}:snapshot"
+        self.lock_key = f"{prefix}:lock"
+        self.clock = clock
+        self.sleep = sleep
+        self.rebuilds = 0
+
+    def load(self):
+        value = self.store.get(self.key)
+        return None if value is None else pickle.loads(value)
+
+    def get(self):
+        """The current snapshot, {'built_at', 'messages', 'html'}, rebuilding
+        it first if it's stale and no one else is; None if there's none
+        yet and it didn't appear within `wait` seconds, or rebuilding it
+        failed."""
+
+        snapshot = self.load()
+        if snapshot and self.clock() - snapshot['built_at'] < self.ttl:
+            return snapshot
+
+        try:
+            rebuilt = self.try_rebuild()
+        except Exception:
+            logger.exception("Rebuilding the public timeline failed; serving the previous snapshot")
+            db.session.rollback()
+            return snapshot
+        if rebuilt or snapshot:
+            return rebuilt or snapshot
+
+        # cold start with someone else rebuilding: wait for their snapshot
+        deadline = self.clock() + self.wait
+        while self.clock() < deadline:
+            self.sleep(0.05)
+            snapshot = self.load()
+            if snapshot:
+                return snapshot
+        return None
+
+    def try_rebuild(self):
+        """Rebuild the snapshot if the lock is free; None if it isn't."""
+
+        token = uuid.uuid4().hex
+        if not self.store.set(self.lock_key, token, ex=self.lock_timeout, nx=True):
+            return None
+
+        try:
+            return self.rebuild()
+        finally:
+            held = self.store.get(self.lock_key)
+            if held in (token, token.encode()):
+                self.store.delete(self.lock_key)
+
+    def rebuild(self):
+        """Query and render a new snapshot and store it. Snapshots are kept
+        well past `ttl` so there's a stale one to serve during rebuilds."""
+
+        messages = latest_messages(self.limit)
+        snapshot = {
+            'built_at': self.clock(),
+            'messages': messages,
+            'html': render_template('messages/_public_timeline.html', messages=messages),
+        }
+        self.store.set(self.key, pickle.dumps(snapshot), ex=max(self.ttl * 100, 3600))
+        self.rebuilds += 1
+        return snapshot
+
+    def clear(self):
+        self.store.delete(self.key)
+        self.store.delete(self.lock_key)
@@ -0,0 +1,140 @@
+"""Publish/subscribe for pushing new warbles to connected timelines.
+
+LocalBroker delivers events to subscribers in this process. RedisBroker
+publishes through Redis so every worker process hears every event; each
+process runs one listener thread that hands events to its local
+subscribers. The listener outlives bad messages and lost connections: it
+logs them, then reconnects after a growing delay.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A subscriber's queue of events on a set of channels."""
+
+    def __init__(self, channels, maxsize=100):
+        self.channels = set(channels)
+        self.events = queue.Queue(maxsize=maxsize)
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrives within `timeout`."""
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LocalBroker:
+    """In-process broker."""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(channels)
+
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.subscribers.get(channel, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self.subscribers.pop(channel, None)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.events.put_nowait(event)
+            except queue.Full:
+                # a client that stopped reading shouldn't block the publisher
+                pass
+
+
+class RedisBroker(LocalBroker):
+    """Broker that fans events out to every process through Redis."""
+
+    def __init__(self, client, prefix='warbler:', retry_delay=0.5, max_retry_delay=30):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.listener = None
+
+    def subscribe(self, channels):
+        self.start()
+        return super().subscribe(channels)
+
+    def publish(self, channel, event):
+        self.client.publish(self.prefix + channel, json.dumps(event))
+
+    def start(self):
+        """Start this process's listener thread, once."""
+
+        with self.lock:
+            if self.listener and self.listener.is_alive():
+                return
+            self.listener = threading.Thread(target=self.listen, daemon=True)
+            self.listener.start()
+
+    def deliver(self, message):
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        LocalBroker.publish(self, channel[len(self.prefix):], json.loads(message['data']))
+
+    def listen(self):
+        """Hand events to local subscribers until the process exits."""
+
+        delay = self.retry_delay
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                delay = self.retry_delay
+
+                for message in pubsub.listen():
+                    try:
+                        self.deliver(message)
+                    except Exception:
+                        logger.exception("Dropped malformed pub/sub message %r", message)
+            except Exception:
+                logger.exception("Pub/sub connection lost; reconnecting in %.1fs", delay)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+
+def make_broker(config):
+    """Build the broker for `config['PUBSUB_REDIS_URL']`, if set."""
+
+    if config.get('PUBSUB_REDIS_URL'):
+        import redis
+        return RedisBroker(redis.Redis.from_url(config['PUBSUB_REDIS_URL']))
+
+    return LocalBroker()
@@ -0,0 +1,137 @@
+"""Rate limiting and load shedding for write routes.
+
+RateLimiter keeps a token bucket per (route, user) and per (route, IP
+address). Buckets live in a BucketStore: MemoryBucketStore for a single
+process, or RedisBucketStore to share them between worker processes.
+
+LoadShedder caps the number of write requests in flight and refuses new
+ones while the time spent waiting for a database connection is above a
+threshold.
+"""
+
+import math
+import threading
+import time
+
+
+class MemoryBucketStore:
+    """Token buckets held in this process."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from bucket `key`, refilling at `rate` tokens per
+        second up to `burst`. Return 0 if allowed, else seconds until a
+        token is available."""
+
+        now = self.clock()
+
+        with self.lock:
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+
+class RedisBucketStore:
+    """Token buckets kept in Redis, updated atomically by a Lua script."""
+
+    SCRIPT = """
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or burst)
+    local last = tonumber(redis.call('HGET', KEYS[1], 'last') or now)
+    tokens = math.min(burst, tokens + math.max(now - last, 0) * rate)
+    local retry = 0
+    if tokens >= 1 then tokens = tokens - 1 else retry = (1 - tokens) / rate end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens, 'last', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(retry)
+    """
+
+    def __init__(self, client, prefix='warbler:ratelimit:'):
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=[self.prefix + key], args=[rate, burst, time.time()]))
+
+
+class RateLimiter:
+    """Apply per-route limits of the form
+
+        {endpoint: {'user': (rate, burst), 'ip': (rate, burst)}}
+
+    where rate is tokens per second and burst is the bucket size.
+    """
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def check(self, endpoint, user_id, ip):
+        """Return 0 if the request may go ahead, else seconds to wait."""
+
+        limits = self.limits.get(endpoint, {})
+        waits = []
+
+        if user_id is not None and 'user' in limits:
+            waits.append(self.store.take(f"{endpoint}:user:{user_id}", *limits['user']))
+        if 'ip' in limits:
+            waits.append(self.store.take(f"{endpoint}:ip:{ip}", *limits['ip']))
+
+        return max(waits, default=0)
+
+
+class LoadShedder:
+    """Bound concurrent write requests; refuse them while the database
+    connection pool is slow to hand out connections."""
+
+    def __init__(self, max_concurrent=20, wait_threshold=0.5, smoothing=0.2):
+        self.max_concurrent = max_concurrent
+        self.wait_threshold = wait_threshold
+        self.smoothing = smoothing
+
+        self.pool_wait = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def record_wait(self, seconds):
+        """Fold one connection checkout time into the moving average."""
+
+        with self.lock:
+            self.pool_wait += self.smoothing * (seconds - self.pool_wait)
+
+    def acquire(self):
+        """Claim a slot for a write request; False means shed it."""
+
+        with self.lock:
+            if self.in_flight >= self.max_concurrent or self.pool_wait > self.wait_threshold:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def make_bucket_store(config):
+    """Build the bucket store for `config['RATELIMIT_REDIS_URL']`, if set."""
+
+    if config.get('RATELIMIT_REDIS_URL'):
+        import redis
+        return RedisBucketStore(redis.Redis.from_url(config['RATELIMIT_REDIS_URL']))
+
+    return MemoryBucketStore()
+
+
+def retry_after_header(seconds):
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,302 @@
+"""Slow-query log.
+
+`SlowQueryLog.watch(engine)` times every statement the engine runs. One
+that takes longer than `threshold` seconds is written to a rotating log
+file as a JSON line with:
+
+- the statement with its parameters redacted (only their types are kept,
+  and literals in the SQL itself are replaced by ?),
+- a fingerprint shared by every statement that differs only in those
+  values, for grouping,
+- the Flask endpoint and method of the request that ran it,
+- on Postgres, the plan from EXPLAIN (ANALYZE, BUFFERS), with quoted
+  literals redacted.
+
+An EXECUTE of a server-side prepared statement is explained through the
+SQL it was prepared from, looked up with the `prepared` callable, since
+the statement isn't prepared on the connection EXPLAIN runs on. That SQL
+is also logged, redacted, under 'prepared'.
+
+EXPLAIN ANALYZE runs the statement again, so it's only done for SELECTs,
+at most once per fingerprint every `explain_interval` seconds, on a
+separate connection in a background thread so the request isn't held up
+by it. `summarize` groups the log's entries by fingerprint.
+"""
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"(?<![\w$.])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+|\?")
+LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+SPACE_RE = re.compile(r"\s+")
+EXECUTE_RE = re.compile(r"^\s*EXECUTE\s+(\w+)\s*(?:\((.*)\))?\s*$", re.IGNORECASE | re.DOTALL)
+PREPARED_PARAM_RE = re.compile(r"\$(\d+)\b")
+
+EXPLAINABLE = ('select', 'with')
+
+
+def redact(statement):
+    """`statement` with its literals replaced by ?, and whitespace collapsed."""
+
+    statement = STRING_RE.sub('?', statement)
+    statement = NUMBER_RE.sub('?', statement)
+    return SPACE_RE.sub(' ', statement).strip()
+
+
+def normalize(statement):
+    """Redacted `statement` with placeholders in any paramstyle as ?, and
+    IN lists of any length as one, so similar statements compare equal."""
+
+    statement = PLACEHOLDER_RE.sub('?', redact(statement))
+    return LIST_RE.sub('(?+)', statement)
+
+
+def fingerprint(statement):
+    return hashlib.sha1(normalize(statement).encode()).hexdigest()[:12]
+
+
+def expand_execute(statement, prepared, escape_percent=False):
+    """The SQL an `EXECUTE name (args)` statement runs, with $n replaced by
+    the n'th argument cast to its declared type; None if `statement` isn't
+    an EXECUTE or `prepared(name)` doesn't know it.
+
+    `prepared(name)` returns (param_types, sql) or None. Set
+    `escape_percent` for drivers with a format paramstyle, so % in the
+    prepared SQL isn't taken for a placeholder.
+    """
+
+    match = EXECUTE_RE.match(statement)
+    if not match or prepared is None:
+        return None
+    found = prepared(match.group(1))
+    if found is None:
+        return None
+
+    param_types, sql = found
+    args = [arg.strip() for arg in match.group(2).split(',')] if match.group(2) else []
+    if len(args) != len(param_types):
+        return None
+    if escape_percent:
+        sql = sql.replace('%', '%%')
+    return PREPARED_PARAM_RE.sub(lambda m: f"({args[int(m.group(1)) - 1]})::{param_types[int(m.group(1)) - 1]}", sql)
+
+
+def redact_parameters(parameters):
+    """Types of the bound values, in place of the values themselves."""
+
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def make_logger(path, max_bytes, backup_count):
+    logger = logging.getLogger(f"warbler.slowlog.{path}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+    return logger
+
+
+class SlowQueryLog:
+    """Record statements slower than `threshold` seconds to `path`."""
+
+    def __init__(self, path, threshold=0.2, explain=True, explain_interval=60,
+                 max_bytes=10 * 1024 * 1024, backup_count=5, clock=time.perf_counter, prepared=None):
+        self.path = path
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.clock = clock
+        self.prepared = prepared
+
+        self.logger = None
+        self.listeners = []
+        self.explained = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=100)
+        self.worker = None
+
+    def watch(self, engine):
+        """Time every statement run by `engine`."""
+
+        def start_timer(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('slowlog_start', []).append(self.clock())
+
+        def stop_timer(conn, cursor, statement, parameters, context, executemany):
+            elapsed = self.clock() - conn.info['slowlog_start'].pop()
+            if elapsed >= self.threshold:
+                self.record(engine, statement, parameters, executemany, elapsed)
+
+        def drop_timer(context):
+            starts = context.connection.info.get('slowlog_start') if context.connection else None
+            if starts:
+                starts.pop()
+
+        for name, listener in [('before_cursor_execute', start_timer),
+                               ('after_cursor_execute', stop_timer),
+                               ('handle_error', drop_timer)]:
+            event.listen(engine, name, listener)
+            self.listeners.append((engine, name, listener))
+
+    def unwatch(self):
+        for engine, name, listener in self.listeners:
+            event.remove(engine, name, listener)
+        self.listeners = []
+
+    def record(self, engine, statement, parameters, executemany, elapsed):
+        """Queue an entry for the slow statement; the worker thread runs the
+        EXPLAIN, if any, and writes it out."""
+
+        entry = {
+            'at': datetime.utcnow().isoformat(timespec='milliseconds'),
+            'duration': round(elapsed, 6),
+            'fingerprint': fingerprint(statement),
+            'statement': redact(statement),
+            'parameters': redact_parameters(parameters),
+            'executemany': executemany,
+            'endpoint': request.endpoint if has_request_context() else None,
+            'method': request.method if has_request_context() else None,
+        }
+
+        expanded = expand_execute(statement, self.prepared,
+                                  escape_percent=engine.dialect.paramstyle in ('format', 'pyformat'))
+        if expanded is not None:
+            entry['prepared'] = redact(expanded)
+            statement = expanded
+
+        explain = self.should_explain(engine, statement, executemany, entry['fingerprint'])
+        try:
+            self.queue.put_nowait((entry, engine, statement, parameters if explain else None, explain))
+        except queue.Full:
+            return
+        self.start_worker()
+
+    def should_explain(self, engine, statement, executemany, key):
+        if (not self.explain or executemany or engine.dialect.name != 'postgresql'
+                or not statement.lstrip().lower().startswith(EXPLAINABLE)):
+            return False
+
+        now = time.monotonic()
+        with self.lock:
+            if now - self.explained.get(key, -self.explain_interval) < self.explain_interval:
+                return False
+            self.explained[key] = now
+            return True
+
+    def start_worker(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, name='slowlog', daemon=True)
+                self.worker.start()
+
+    def work(self):
+        while True:
+            entry, engine, statement, parameters, explain = self.queue.get()
+            try:
+                if explain:
+                    entry['plan'] = self.explain_plan(engine, statement, parameters)
+                self.write(entry)
+            finally:
+                self.queue.task_done()
+
+    def explain_plan(self, engine, statement, parameters):
+        """EXPLAIN (ANALYZE, BUFFERS) output for the statement, run on its
+        own connection and rolled back; None if it fails."""
+
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            return STRING_RE.sub("'?'", plan)
+        except Exception as exc:
+            return f"EXPLAIN failed: {type(exc).__name__}"
+        finally:
+            raw.rollback()
+            raw.close()
+
+    def write(self, entry):
+        if self.logger is None:
+            self.logger = make_logger(self.path, self.max_bytes, self.backup_count)
+        self.logger.info(json.dumps(entry, sort_keys=True))
+
+    def flush(self):
+        """Wait for queued entries to be written."""
+
+        self.queue.join()
+
+
+def read_entries(path):
+    """Entries from `path` and its rotated backups, oldest file first."""
+
+    paths = [path]
+    n = 1
+    while os.path.exists(f"{path}.{n}"):
+        paths.insert(0, f"{path}.{n}")
+        n += 1
+
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path) as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summarize(entries):
+    """Group entries by fingerprint, slowest total time first.
+
+    Each group has the count, total/mean/max duration, the endpoints that
+    ran it, one redacted statement and the latest plan captured.
+    """
+
+    groups = {}
+    for entry in entries:
+        group = groups.setdefault(entry['fingerprint'], {
+            'fingerprint': entry['fingerprint'],
+            'statement': entry['statement'],
+            'count': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'endpoints': Counter(),
+            'plan': None,
+            'last_seen': None,
+        })
+        group['count'] += 1
+        group['total'] += entry['duration']
+        group['max'] = max(group['max'], entry['duration'])
+        group['endpoints'][entry.get('endpoint') or '-'] += 1
+        group['last_seen'] = entry['at']
+        if entry.get('plan'):
+            group['plan'] = entry['plan']
+
+    summary = sorted(groups.values(), key=lambda group: group['total'], reverse=True)
+    for group in summary:
+        group['mean'] = group['total'] / group['count']
+        group['endpoints'] = dict(group['endpoints'].most_common())
+    return summary
@@ -0,0 +1,190 @@
+"""Time-sortable 64-bit ids.
+
+An id packs, from the top bit down:
+
+- 41 bits of milliseconds since EPOCH (enough until 2069),
+- 10 bits of worker id,
+- 12 bits of a sequence within the millisecond,
+
+so ids sort by creation time and a timeline can be ordered and
+paginated by primary key alone.
+
+Each process needs its own worker id for ids to be unique. On Postgres a
+process claims one the first time it makes an id, by taking a session
+advisory lock on it over a connection held open for the life of the
+process; the lock goes away with the process. A forked child claims its
+own. Elsewhere (SQLite in development and tests) the worker id is 0, or
+whatever is configured.
+
+If more than 4096 ids are needed within a millisecond, or the clock goes
+backwards, the generator borrows the next millisecond rather than wait,
+so ids from one worker always increase.
+
+Rows dated in the past (imported messages) get ids from `backdated_ids`
+instead, under a worker id of their own.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+# early enough for any message we might backfill
+EPOCH = datetime(2000, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# ids below this predate snowflake ids (they fit a 32-bit serial)
+MIN_ID = 1 << 31
+
+# reserved for ids given to existing rows by the backfill, never claimed
+BACKFILL_WORKER_ID = MAX_WORKER_ID
+# reserved for backdated ids, e.g. imported messages, never claimed
+IMPORT_WORKER_ID = MAX_WORKER_ID - 1
+# worker ids below this are the ones processes claim or are configured with
+WORKER_IDS = IMPORT_WORKER_ID
+
+# first key of the (key, worker id) advisory locks
+ADVISORY_LOCK_KEY = 0x5742
+
+
+class WorkerIdsExhausted(Exception):
+    """Every worker id is held by another process."""
+
+
+def ms_of(when):
+    """Milliseconds since the Unix epoch of naive UTC datetime `when`."""
+
+    return int((when - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def make_id(ms, worker_id, sequence):
+    return ((ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def timestamp_of(id):
+    """When `id` was made, as a naive UTC datetime (to the millisecond)."""
+
+    return EPOCH + timedelta(milliseconds=id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+def min_id_at(when):
+    """The smallest id that can be made at or after `when`."""
+
+    return make_id(ms_of(when), 0, 0)
+
+
+# the earliest time an id can be made for without falling below MIN_ID
+MIN_TIMESTAMP = timestamp_of(MIN_ID)
+
+
+def check_worker_id(worker_id):
+    """`worker_id`, if a process may use it (None for unset)."""
+
+    if worker_id is not None and not 0 <= worker_id < WORKER_IDS:
+        raise ValueError(f"Worker ids run from 0 to {WORKER_IDS - 1}; {worker_id} is reserved or out of range.")
+    return worker_id
+
+
+def claim_worker_id(engine):
+    """Take a free worker id on Postgres; returns (worker id, the raw
+    connection holding its advisory lock)."""
+
+    raw = engine.raw_connection()
+    raw.detach()
+    cursor = raw.cursor()
+
+    start = os.getpid() % WORKER_IDS
+    for n in range(WORKER_IDS):
+        worker_id = (start + n) % WORKER_IDS
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (ADVISORY_LOCK_KEY, worker_id))
+        if cursor.fetchone()[0]:
+            raw.commit()
+            return worker_id, raw
+
+    raw.close()
+    raise WorkerIdsExhausted(f"All {WORKER_IDS} worker ids are taken.")
+
+
+class IdGenerator:
+    """Make ids for one process; thread-safe."""
+
+    def __init__(self, worker_id=None, clock=time.time):
+        self.worker_id = worker_id
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.claimed = None
+        # every claim's connection, including a parent process's: closing
+        # an inherited one would end the parent's session and its lock
+        self.connections = []
+        self.pid = None
+        self.last_ms = 0
+        self.sequence = 0
+
+    def worker_for(self, engine):
+        if self.worker_id is not None:
+            return self.worker_id
+
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if engine is not None and engine.dialect.name == 'postgresql':
+                self.claimed, connection = claim_worker_id(engine)
+                self.connections.append(connection)
+            else:
+                self.claimed = 0
+        return self.claimed
+
+    def next_id_at(self, ms, engine=None):
+        """The next id for a row made at `ms` (Unix milliseconds), or
+        later if this worker has already made ids past it."""
+
+        with self.lock:
+            worker_id = self.worker_for(engine)
+
+            if ms > self.last_ms:
+                self.last_ms, self.sequence = ms, 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                self.last_ms, self.sequence = self.last_ms + 1, 0
+
+            return make_id(self.last_ms, worker_id, self.sequence)
+
+    def next_id(self, engine=None):
+        return self.next_id_at(int(self.clock() * 1000), engine)
+
+
+def backdated_ids(times_ms, worker_id=IMPORT_WORKER_ID):
+    """Ids for rows made at `times_ms` (Unix milliseconds), in order.
+
+    Unlike IdGenerator's, these keep each row's own millisecond, however
+    the times are ordered. Rows sharing a millisecond take consecutive
+    sequence numbers from a random start. Other processes may make ids
+    for the same worker and millisecond, so they can collide; callers
+    retry with fresh ids on a unique violation.
+    """
+
+    sequences = {}
+    ids = []
+    for ms in times_ms:
+        sequence = sequences.get(ms)
+        if sequence is None:
+            sequence = random.randrange(MAX_SEQUENCE + 1)
+        sequences[ms] = (sequence + 1) & MAX_SEQUENCE
+        ids.append(make_id(ms, worker_id, sequence))
+    return ids
+
+
+message_ids = IdGenerator()
+
+
+def next_message_id(context):
+    """Column default for message ids."""
+
+    return message_ids.next_id(context.connection.engine if context is not None else None)
@@ -0,0 +1,175 @@
+"""Progressive template rendering and response compression.
+
+`stream_template` renders a template as a generator, so the response
+starts going out before the whole page exists. Output is sent in
+CHUNK_SIZE pieces, and straight away wherever the template outputs
+`{{ stream_flush }}`; base.html does that right after the navbar, so the
+browser can fetch CSS while the view is still querying the timeline. For
+that to help, views pass their query results as `LazyList`s, which run
+the query the first time the template touches them.
+
+`compress_response` gzip- or brotli-encodes a response for clients that
+accept it, a chunk at a time for streamed responses (each chunk is
+flushed through the compressor so streaming isn't held up).
+"""
+
+import zlib
+
+from flask import current_app
+from markupsafe import Markup
+
+from assets import accepted_encodings
+
+CHUNK_SIZE = 8192
+
+FLUSH_MARKER = '<!--flush-->'
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript'}
+
+# don't bother compressing bodies smaller than this
+MIN_COMPRESS_SIZE = 500
+
+
+class LazyList:
+    """A list produced by `load` the first time it's used."""
+
+    def __init__(self, load):
+        self.load = load
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = list(self.load())
+        return self._value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __bool__(self):
+        return bool(self.value)
+
+
+def stream_template(template_name, **context):
+    """Yield the rendered template in chunks; like render_template(), but
+    without building the whole page first."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    context['stream_flush'] = Markup(FLUSH_MARKER)
+
+    buffer = []
+    size = 0
+
+    for piece in app.jinja_env.get_template(template_name).generate(context):
+        flush = FLUSH_MARKER in piece
+        if flush:
+            piece = piece.replace(FLUSH_MARKER, '')
+
+        buffer.append(piece)
+        size += len(piece)
+
+        if flush or size >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self):
+        # wbits 16 + 15: gzip header and trailer
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self):
+        import brotli
+        self.compressor = brotli.Compressor(quality=5)
+
+    def chunk(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def encoders():
+    """Encoder classes available here, preferred first; brotli needs the
+    optional `brotli` package."""
+
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return [GzipEncoder]
+    return [BrotliEncoder, GzipEncoder]
+
+
+def choose_encoder(accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    for encoder in encoders():
+        if encoder.name in accepted:
+            return encoder
+    return None
+
+
+def encode_stream(chunks, encoder):
+    """Compress an iterable of str or bytes chunks, closing it when done
+    (which is what ends a stream_with_context() request)."""
+
+    try:
+        for data in chunks:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if data:
+                yield encoder.chunk(data)
+        yield encoder.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response, accept_encoding):
+    """Compress `response` in place if the client and content type allow it."""
+
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    encoder_class = choose_encoder(accept_encoding)
+    response.vary.add('Accept-Encoding')
+    if not encoder_class:
+        return response
+
+    if response.is_streamed:
+        response.response = encode_stream(response.response, encoder_class())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_SIZE:
+            return response
+        encoder = encoder_class()
+        response.set_data(encoder.chunk(data) + encoder.finish())
+
+    response.headers['Content-Encoding'] = encoder_class.name
+    return response
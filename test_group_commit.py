@@ -0,0 +1,98 @@
+"""Group commit tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_group_commit.py
+
+
+import threading
+from unittest import TestCase
+
+from sqlalchemy import Table, Column, Integer, MetaData, create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from group_commit import GroupCommitter
+
+
+class GroupCommitTestCase(TestCase):
+    """Test coalescing of concurrent inserts."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', connect_args={'check_same_thread': False},
+                                    poolclass=StaticPool)
+        self.table = Table('rows', MetaData(), Column('id', Integer, primary_key=True),
+                           Column('n', Integer, nullable=False))
+        self.table.create(self.engine)
+
+        self.commits = 0
+
+        @event.listens_for(self.engine, 'commit')
+        def count_commit(conn):
+            self.commits += 1
+
+    def test_concurrent_inserts_share_a_transaction(self):
+        """Inserts submitted within the window commit together"""
+
+        committer = GroupCommitter(self.table, window=0.1)
+        keys = []
+
+        threads = [threading.Thread(target=lambda n=n: keys.append(committer.submit(self.engine, {'n': n})['id']))
+                   for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(keys), [1, 2, 3, 4, 5])
+        self.assertEqual(self.commits, 1)
+
+    def test_failed_batch_raises(self):
+        """A failed transaction is reported to the caller instead of acknowledged"""
+
+        committer = GroupCommitter(self.table, window=0)
+
+        with self.assertRaises(Exception):
+            committer.submit(self.engine, {'n': None})
+        self.assertEqual(committer.submit(self.engine, {'n': 1}), {'id': 1, 'n': 1})
+
+    def test_bad_row_fails_alone(self):
+        """The other rows of a failed batch are retried and committed"""
+
+        committer = GroupCommitter(self.table, window=0.1)
+        results = {}
+
+        def submit(n):
+            try:
+                results[n] = committer.submit(self.engine, {'n': n})['n']
+            except Exception:
+                results[n] = 'failed'
+
+        threads = [threading.Thread(target=submit, args=(n,)) for n in (1, None, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {1: 1, None: 'failed', 3: 3})
+        with self.engine.connect() as conn:
+            self.assertEqual(sorted(row.n for row in conn.execute(self.table.select())), [1, 3])
+
+    def test_on_insert_in_same_transaction(self):
+        """Rows written by on_insert commit or roll back with the batch"""
+
+        log = Table('log', self.table.metadata, Column('row_id', Integer, nullable=False))
+        log.create(self.engine)
+
+        def on_insert(conn, rows):
+            conn.execute(log.insert(), [{'row_id': row['id']} for row in rows])
+            if any(row['n'] == 13 for row in rows):
+                raise ValueError("unlucky")
+
+        committer = GroupCommitter(self.table, window=0, on_insert=on_insert)
+        committer.submit(self.engine, {'n': 1})
+        with self.assertRaises(ValueError):
+            committer.submit(self.engine, {'n': 13})
+
+        with self.engine.connect() as conn:
+            self.assertEqual([row_id for (row_id,) in conn.execute(log.select())], [1])
+            self.assertEqual(conn.execute(self.table.select()).fetchall(), [(1, 1)])
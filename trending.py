@@ -0,0 +1,237 @@
+"""Trending warbles, ranked by time-decayed like velocity.
+
+Likes are counted into fixed-width time buckets per message and kept in
+memory; the explore page reads the top messages from there instead of
+aggregating the likes table. Every `snapshot_interval` seconds a
+background thread in each process adds the likes it counted since its
+last snapshot to the `trending_counts` table, then reloads the counters
+from it, so processes see each other's likes and a restarted process
+picks up where it left off.
+
+Counts are signed: an unlike in one process can arrive before the like
+it undoes has reached it from another. Negative counts only read as zero
+when scoring.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from models import db, Message, TrendingCount
+
+BUCKET_SECONDS = 300
+NUM_BUCKETS = 24
+HALF_LIFE_SECONDS = 3600
+SNAPSHOT_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class TrendingTracker:
+    """Rolling per-message like counters with a top-K ranking.
+
+    Counts for a message live in a dict of {bucket number: likes}; buckets
+    older than `num_buckets` windows are dropped as they age out.
+    """
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, num_buckets=NUM_BUCKETS,
+                 half_life=HALF_LIFE_SECONDS, snapshot_interval=SNAPSHOT_INTERVAL,
+                 clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.half_life = half_life
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock
+
+        self.counts = defaultdict(dict)
+        # {(message_id, bucket): change since the last snapshot}
+        self.deltas = defaultdict(int)
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.app = None
+        self.snapshotter = None
+
+    def init_app(self, app):
+        """Snapshot in the background from the first recorded like on, with
+        an app context from `app`."""
+
+        self.app = app
+
+    def start(self):
+        """Start this process's snapshot thread, once (and again if it died,
+        or the process was forked)."""
+
+        if self.app is None:
+            return
+
+        with self.lock:
+            if self.snapshotter and self.snapshotter.is_alive():
+                return
+            self.snapshotter = threading.Thread(target=self.run, daemon=True)
+            self.snapshotter.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            with self.app.app_context():
+                try:
+                    self.snapshot()
+                except Exception:
+                    logger.exception("Trending snapshot failed; retrying next interval")
+                    db.session.rollback()
+
+    def current_bucket(self):
+        return int(self.clock() // self.bucket_seconds)
+
+    def record(self, message_id, delta=1):
+        """Add `delta` likes to `message_id` in the current bucket."""
+
+        self.ensure_loaded()
+        bucket = self.current_bucket()
+
+        with self.lock:
+            buckets = self.counts[message_id]
+            buckets[bucket] = buckets.get(bucket, 0) + delta
+            self.deltas[(message_id, bucket)] += delta
+
+        self.start()
+
+    def record_like(self, message_id):
+        self.record(message_id, 1)
+
+    def record_unlike(self, message_id):
+        self.record(message_id, -1)
+
+    def forget(self, message_id):
+        """Drop all counters for a deleted message."""
+
+        with self.lock:
+            self.counts.pop(message_id, None)
+            for key in [key for key in self.deltas if key[0] == message_id]:
+                del self.deltas[key]
+
+    def prune(self):
+        """Drop buckets that have fallen out of the rolling window."""
+
+        oldest = self.current_bucket() - self.num_buckets + 1
+
+        with self.lock:
+            for message_id in list(self.counts):
+                buckets = self.counts[message_id]
+                for bucket in [b for b in buckets if b < oldest]:
+                    del buckets[bucket]
+                if not buckets:
+                    del self.counts[message_id]
+            for key in [key for key in self.deltas if key[1] < oldest]:
+                del self.deltas[key]
+
+    def score(self, buckets, now_bucket):
+        """Sum of bucket counts, each halved every `half_life` seconds of age."""
+
+        return sum(
+            max(count, 0) * 0.5 ** ((now_bucket - bucket) * self.bucket_seconds / self.half_life)
+            for bucket, count in buckets.items()
+        )
+
+    def top(self, k=20):
+        """Return [(message_id, score), ...] for the `k` hottest messages."""
+
+        self.ensure_loaded()
+        self.prune()
+        now_bucket = self.current_bucket()
+
+        with self.lock:
+            scores = ((message_id, self.score(buckets, now_bucket))
+                      for message_id, buckets in self.counts.items())
+            return heapq.nlargest(k, (s for s in scores if s[1] > 0), key=lambda s: s[1])
+
+    def ensure_loaded(self):
+        """Seed counters from the last snapshot, once per process."""
+
+        if self.loaded:
+            return
+
+        oldest = self.current_bucket() - self.num_buckets + 1
+        rows = TrendingCount.query.filter(TrendingCount.bucket >= oldest).all()
+
+        with self.lock:
+            for row in rows:
+                self.counts[row.message_id].setdefault(row.bucket, row.count)
+            self.loaded = True
+
+    def snapshot(self):
+        """Add this process's changes to the database, drop expired rows and
+        reload the counters, which now include other processes' likes.
+
+        Changes for messages deleted since are dropped. If writing fails,
+        the changes are kept for the next snapshot.
+        """
+
+        with self.lock:
+            deltas, self.deltas = self.deltas, defaultdict(int)
+
+        oldest = self.current_bucket() - self.num_buckets + 1
+
+        try:
+            ids = list({message_id for (message_id, bucket), delta in deltas.items() if delta})
+            live = set()
+            if ids:
+                live = {id for (id,) in db.session.query(Message.id).filter(Message.id.in_(ids))}
+
+            add_counts([{'message_id': message_id, 'bucket': bucket, 'delta': delta}
+                        for (message_id, bucket), delta in deltas.items() if delta and message_id in live])
+            TrendingCount.query.filter(TrendingCount.bucket < oldest).delete()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self.lock:
+                for key, delta in deltas.items():
+                    self.deltas[key] += delta
+            raise
+
+        rows = (db.session.query(TrendingCount.message_id, TrendingCount.bucket, TrendingCount.count)
+                .filter(TrendingCount.bucket >= oldest)
+                .all())
+
+        with self.lock:
+            self.counts = defaultdict(dict)
+            for message_id, bucket, count in rows:
+                self.counts[message_id][bucket] = count
+            # likes counted while the snapshot ran
+            for (message_id, bucket), delta in self.deltas.items():
+                buckets = self.counts[message_id]
+                buckets[bucket] = buckets.get(bucket, 0) + delta
+
+
+def add_counts(rows):
+    """Add each row's `delta` to its (message_id, bucket) count, creating
+    missing rows. Doesn't commit."""
+
+    if not rows:
+        return
+
+    table = TrendingCount.__table__
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        stmt = pg_insert(table)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.message_id, table.c.bucket],
+            set_={'count': table.c.count + stmt.excluded.count}),
+            [{'message_id': row['message_id'], 'bucket': row['bucket'], 'count': row['delta']} for row in rows])
+        return
+
+    for row in rows:
+        updated = db.session.execute(
+            table.update()
+            .where(table.c.message_id == row['message_id'], table.c.bucket == row['bucket'])
+            .values(count=table.c.count + row['delta'])).rowcount
+        if not updated:
+            db.session.execute(table.insert().values(message_id=row['message_id'], bucket=row['bucket'],
+                                                     count=row['delta']))
+
+
+tracker = TrendingTracker()